@@ -2,10 +2,12 @@ import os
 import sys
 import yaml
 import psycopg2
+import hashlib
 import argparse
+from twitter.helper import get_partition_cmd
 
 
-def main(config_f='config.yaml'):
+def main(config_f='config.yaml', migrate=False):
     """
     Initializes the directory structure and PostgreSQL database tables for
     collecting social media event data
@@ -18,6 +20,14 @@ def main(config_f='config.yaml'):
        `output.psql.platform` fields in the config.file. The fields of the
        tables and their data types are specified by `insert_fields.platform`.
        The table names should be the same as the keys of `insert_fields.platform`
+    4. If `output.psql.platform.partition_by` is "event", creates the tables
+       as partitioned by event, with a default partition for any event that
+       does not have its own partition yet. Each listener creates the
+       partitions for its event when it starts
+    5. Creates the indexes in `output.psql.platform.indexes`, which support
+       the queries that searches run on an event's tweets. Indexes are built
+       concurrently after the tables are committed, so collectors that are
+       already writing to large tables are not blocked while they are built
 
     NOTE: This configuration script does not create the PostgreSQL database or
     user itself. It assumes that the database has already been properly
@@ -29,6 +39,11 @@ def main(config_f='config.yaml'):
         Filename of the configuration file to use. Defaults to `config.yaml`,
         which assumes that it is in the same directory as where this script is
         being run
+    migrate: bool
+        If True, converts existing tables that are not partitioned into
+        partitioned tables, if the config file sets `partition_by`. The rows
+        are copied into the new tables in a single transaction and the old
+        tables are kept, renamed with an `_unpartitioned` suffix
     """
     # Load config file
     with open(config_f) as fin:
@@ -54,29 +69,259 @@ def main(config_f='config.yaml'):
                             password=config['psql']['password'])
     cur = conn.cursor()
 
+    index_jobs = []
     for platform in config['output']['psql']:
         schema = config['output']['psql'][platform]['schema']
         schema_cmd = f"CREATE SCHEMA IF NOT EXISTS {schema};"
         cur.execute(schema_cmd)
 
-        for insert_type in config['output']['psql'][platform]['tables']:
-            table = f"{schema}.{insert_type}"
+        psql_config = config['output']['psql'][platform]
+        partition_by = psql_config.get('partition_by')
+        if partition_by not in {None, 'event'}:
+            raise ValueError(f"Unknown partitioning: {partition_by}")
+        index_configs = psql_config.get('indexes') or dict()
+
+        for insert_type,table_name in psql_config['tables'].items():
+            table = f"{schema}.{table_name}"
             insert_field2type = config['insert_fields'][platform][insert_type]
             field_strs = [f"{field} {t}" for field,t in insert_field2type.items()]
             fields_str = ','.join(field_strs)
             fields_str += ", PRIMARY KEY (id, event)"
+            index_config = index_configs.get(insert_type) or dict()
+
+            if partition_by is not None and migrate:
+                migrate_table(cur, schema, table_name, insert_field2type.keys(),
+                              fields_str, index_config)
+            elif partition_by is not None:
+                create_partitioned_table(cur, schema, table_name, fields_str)
+            else:
+                create_cmd = f"CREATE TABLE IF NOT EXISTS {table} ({fields_str});"
+                cur.execute(create_cmd)
 
-            create_cmd = f"CREATE TABLE IF NOT EXISTS {table} ({fields_str});"
-            cur.execute(create_cmd)
+            for index_name,index_def in index_config.items():
+                index_jobs.append((schema, table_name, index_name, index_def))
 
     conn.commit()
+
+    # Concurrent index builds cannot run inside a transaction
+    conn.autocommit = True
+    for schema,table_name,index_name,index_def in index_jobs:
+        create_index(cur, schema, table_name, index_name, index_def)
+
     cur.close()
     conn.close()
 
 
+def create_partitioned_table(cur, schema, table_name, fields_str):
+    """
+    Creates a table partitioned by event, if it does not already exist, along
+    with its default partition
+
+    Parameters
+    ----------
+    cur: psycopg2 cursor
+        Cursor of the database connection
+    schema: str
+        Schema of the table
+    table_name: str
+        Name of the table, without its schema
+    fields_str: str
+        Fields, types, and primary key of the table
+    """
+    table = f"{schema}.{table_name}"
+    create_cmd = f"""
+    CREATE TABLE IF NOT EXISTS {table} ({fields_str})
+    PARTITION BY LIST (event);
+    """
+    default_cmd = f"""
+    CREATE TABLE IF NOT EXISTS {table}_default
+    PARTITION OF {table} DEFAULT;
+    """
+    cur.execute(create_cmd)
+    cur.execute(default_cmd)
+
+
+def migrate_table(cur, schema, table_name, fields, fields_str, index_config):
+    """
+    Converts a table that is not partitioned into one partitioned by event,
+    with a partition for each event already in it. The old table is renamed
+    with an `_unpartitioned` suffix and can be dropped once the new table has
+    been checked. Tables that do not exist or are already partitioned are only
+    created if needed
+
+    Parameters
+    ----------
+    cur: psycopg2 cursor
+        Cursor of the database connection
+    schema: str
+        Schema of the table
+    table_name: str
+        Name of the table, without its schema
+    fields: list of strs
+        Fields of the table in the config file
+    fields_str: str
+        Fields, types, and primary key of the table
+    index_config: dict
+        Names and definitions of the table's indexes, which are dropped from
+        the old table so that they can be created on the new one
+    """
+    table = f"{schema}.{table_name}"
+    kind_cmd = """
+    SELECT c.relkind
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = %(schema)s AND c.relname = %(table_name)s
+    """
+    cur.execute(kind_cmd, {'schema': schema, 'table_name': table_name})
+    kind = cur.fetchone()
+    if kind is None or kind[0] == 'p':
+        create_partitioned_table(cur, schema, table_name, fields_str)
+        return
+
+    print(f"Migrating {table} to a partitioned table")
+    old_table_name = f"{table_name}_unpartitioned"
+    old_table = f"{schema}.{old_table_name}"
+    for index_name in index_config:
+        cur.execute(f"DROP INDEX IF EXISTS {schema}.{table_name}_{index_name};")
+    cur.execute(f"ALTER TABLE {table} RENAME TO {old_table_name};")
+    create_partitioned_table(cur, schema, table_name, fields_str)
+
+    cur.execute(f"SELECT DISTINCT event FROM {old_table};")
+    events = [row[0] for row in cur.fetchall() if row[0] is not None]
+    for event in events:
+        cur.execute(get_partition_cmd(table, event), {'event': event})
+
+    # Only copy the fields that the old table has, in case fields were added
+    columns_cmd = """
+    SELECT column_name FROM information_schema.columns
+    WHERE table_schema = %(schema)s AND table_name = %(table_name)s
+    """
+    cur.execute(columns_cmd, {'schema': schema, 'table_name': old_table_name})
+    old_fields = {row[0] for row in cur.fetchall()}
+    fields_str = ','.join(f for f in fields if f in old_fields)
+    copy_cmd = f"""
+    INSERT INTO {table} ({fields_str})
+    SELECT {fields_str} FROM {old_table};
+    """
+    cur.execute(copy_cmd)
+    print(f"Copied {cur.rowcount:,} rows across {len(events):,} events. "
+          f"The old table is kept as {old_table}")
+
+
+def create_index(cur, schema, table_name, index_name, index_def):
+    """
+    Creates an index without blocking writes to the table, if it does not
+    already exist. Partitioned tables cannot be indexed concurrently, so their
+    index is created on the parent table alone and then each partition is
+    indexed concurrently and attached to it. Must be run in autocommit mode
+
+    Parameters
+    ----------
+    cur: psycopg2 cursor
+        Cursor of the database connection
+    schema: str
+        Schema of the table
+    table_name: str
+        Name of the table, without its schema
+    index_name: str
+        Name of the index, which is prefixed with the table name
+    index_def: str
+        Columns of the index and anything after them, e.g. a WHERE clause
+    """
+    table = f"{schema}.{table_name}"
+    parent_index = f"{table_name}_{index_name}"
+    partition_cmd = """
+    SELECT c.relname
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    JOIN pg_class p ON p.oid = i.inhparent
+    JOIN pg_namespace n ON n.oid = p.relnamespace
+    WHERE n.nspname = %(schema)s AND p.relname = %(table_name)s
+    """
+    cur.execute(partition_cmd, {'schema': schema, 'table_name': table_name})
+    partitions = [row[0] for row in cur.fetchall()]
+    kind_cmd = """
+    SELECT c.relkind
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = %(schema)s AND c.relname = %(table_name)s
+    """
+    cur.execute(kind_cmd, {'schema': schema, 'table_name': table_name})
+    partitioned = cur.fetchone()[0] == 'p'
+
+    if not partitioned:
+        create_index_concurrently(cur, schema, parent_index, table, index_def)
+        return
+
+    cur.execute(f"""
+    CREATE INDEX IF NOT EXISTS {parent_index}
+    ON ONLY {table} {index_def};
+    """)
+    # Partitions created after the index already have it attached
+    attached_cmd = """
+    SELECT t.relname
+    FROM pg_inherits i
+    JOIN pg_index x ON x.indexrelid = i.inhrelid
+    JOIN pg_class t ON t.oid = x.indrelid
+    WHERE i.inhparent = %(parent_index)s::regclass
+    """
+    cur.execute(attached_cmd, {'parent_index': f"{schema}.{parent_index}"})
+    attached = {row[0] for row in cur.fetchall()}
+    for partition in partitions:
+        if partition in attached:
+            continue
+        # Short enough for PostgreSQL's 63 character limit on names
+        partition_hash = hashlib.md5(partition.encode('utf-8')).hexdigest()[:8]
+        partition_index = f"{parent_index}_{partition_hash}"
+        create_index_concurrently(cur, schema, partition_index,
+                                  f"{schema}.{partition}", index_def)
+        cur.execute(f"""
+        ALTER INDEX {schema}.{parent_index}
+        ATTACH PARTITION {schema}.{partition_index};
+        """)
+
+
+def create_index_concurrently(cur, schema, index, table, index_def):
+    """
+    Creates an index concurrently, if it does not already exist. An index left
+    invalid by an interrupted concurrent build is dropped and built again
+
+    Parameters
+    ----------
+    cur: psycopg2 cursor
+        Cursor of the database connection, in autocommit mode
+    schema: str
+        Schema of the index
+    index: str
+        Name of the index, without its schema
+    table: str
+        Name of the table to index, including its schema
+    index_def: str
+        Columns of the index and anything after them, e.g. a WHERE clause
+    """
+    valid_cmd = """
+    SELECT i.indisvalid
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = %(schema)s AND c.relname = %(index)s
+    """
+    cur.execute(valid_cmd, {'schema': schema, 'index': index})
+    valid = cur.fetchone()
+    if valid is not None and valid[0]:
+        return
+    if valid is not None:
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {schema}.{index};")
+    print(f"Building index {schema}.{index}")
+    cur.execute(f"""
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS {index}
+    ON {table} {index_def};
+    """)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Social media data pipeline config")
     parser.add_argument("-config", type=str, default="config.yaml")
+    parser.add_argument("--migrate", dest="migrate", action="store_true")
+    parser.set_defaults(migrate=False)
     args = parser.parse_args()
 
-    main(args.config)
+    main(args.config, args.migrate)
@@ -0,0 +1,222 @@
+import os
+import glob
+import gzip
+import json
+import time
+from dateutil import parser
+from datetime import timezone
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class ArchiveWriter():
+    """
+    Writes tweets as compressed newline-delimited JSON, split across segment
+    files that are rotated by size and age. Each write is compressed as its own
+    block (a gzip member or zstd frame), and concatenated blocks are still a
+    valid compressed file, so each segment can be decompressed as a whole with
+    standard tools. A sidecar index records the segment, byte offset, and
+    length of every block along with the range of tweet IDs and creation times
+    in it, so that a block can be read without decompressing the rest of the
+    archive (see `read_archive`)
+
+    Segments are named `{name}_{number}.json.gz` (or `.json.zst`) and the index
+    is `{name}_index.json`, where `name` is the JSON output filename without
+    its extension
+
+    Parameters
+    ----------
+    out_json_fname: str
+        The JSON output filename that the archive replaces
+    write_mode: str
+        Either "a+" to add segments to an existing archive, or "w+" to remove
+        any existing segments and index and start a new archive
+    compression: str
+        Either "gzip" or "zstd". Using zstd requires the `zstandard` package
+    segment_mb: float
+        Size in megabytes after which a new segment is started. Defaults to 1024
+    segment_mins: float
+        Age in minutes after which a new segment is started. Defaults to 1440
+    """
+    def __init__(self,
+                 out_json_fname,
+                 write_mode,
+                 compression,
+                 segment_mb=1024,
+                 segment_mins=1440):
+        if compression == 'gzip':
+            self.ext = 'gz'
+            self.compress = gzip.compress
+        elif compression == 'zstd':
+            if zstandard is None:
+                raise ImportError("zstd compression requires the zstandard package")
+            self.ext = 'zst'
+            self.compress = zstandard.ZstdCompressor().compress
+        else:
+            raise ValueError(f"Unknown compression: {compression}")
+        self.segment_bytes = segment_mb * 1024**2
+        self.segment_secs = segment_mins * 60
+
+        self.name = os.path.splitext(out_json_fname)[0]
+        self.index_fname = f"{self.name}_index.json"
+        segment_pattern = f"{glob.escape(self.name)}_{'[0-9]'*5}.json.{self.ext}"
+        segment_fnames = sorted(glob.glob(segment_pattern))
+        if write_mode == 'w+':
+            for segment_fname in segment_fnames:
+                os.remove(segment_fname)
+            segment_fnames = []
+        self.index_f = open(self.index_fname, write_mode)
+
+        # Continue numbering after any existing segments
+        self.segment_number = len(segment_fnames)
+        self.segment_f = None
+        self.open_segment()
+
+
+    def open_segment(self):
+        """
+        Closes the current segment, if any, and starts the next one
+        """
+        if self.segment_f is not None:
+            self.segment_f.close()
+        self.segment_fname = f"{self.name}_{self.segment_number:05d}.json.{self.ext}"
+        self.segment_f = open(self.segment_fname, 'ab')
+        self.segment_start_time = time.time()
+        self.segment_number += 1
+
+
+    def write_tweets(self, tweets, out_strs):
+        """
+        Compresses and writes a block of tweets, and adds the block to the index
+
+        Parameters
+        ----------
+        tweets: list of dicts
+            Tweets being written, used for the ID and time ranges of the index
+        out_strs: list of strs
+            JSON strings of the tweets, in the same order
+        """
+        if len(tweets) == 0:
+            return
+        segment_age = time.time() - self.segment_start_time
+        if (self.segment_f.tell() >= self.segment_bytes
+            or segment_age >= self.segment_secs):
+            self.open_segment()
+
+        block = self.compress(''.join(f"{s}\n" for s in out_strs).encode('utf-8'))
+        offset = self.segment_f.tell()
+        self.segment_f.write(block)
+        self.segment_f.flush()
+
+        tweet_ids = [int(tweet['id']) for tweet in tweets]
+        created_ats = [tweet['created_at'] for tweet in tweets if 'created_at' in tweet]
+        index_entry = {'segment': os.path.basename(self.segment_fname),
+                       'offset': offset,
+                       'length': len(block),
+                       'n_tweets': len(tweets),
+                       'min_id': str(min(tweet_ids)),
+                       'max_id': str(max(tweet_ids)),
+                       'min_created_at': min(created_ats, default=None),
+                       'max_created_at': max(created_ats, default=None)}
+        self.index_f.write(f"{json.dumps(index_entry)}\n")
+        self.index_f.flush()
+
+
+    def flush(self):
+        """
+        Flushes the current segment and the index. Blocks are already flushed
+        as they are written, so this only matters for a file-like interface
+        """
+        self.segment_f.flush()
+        self.index_f.flush()
+
+
+    def close(self):
+        """
+        Closes the current segment and the index
+        """
+        self.segment_f.close()
+        self.index_f.close()
+
+
+def read_archive(index_fname, tweet_id=None, start_time=None, end_time=None):
+    """
+    Reads tweets from an archive written by `ArchiveWriter`, only decompressing
+    the blocks whose ranges in the index could contain the requested tweets
+
+    Parameters
+    ----------
+    index_fname: str
+        Filename of the archive's index
+    tweet_id: str
+        If given, only yields the tweet with this ID
+    start_time: str
+        If given, only yields tweets created at or after this time
+    end_time: str
+        If given, only yields tweets created before this time
+
+    Yields
+    ------
+    tweet: dict
+        Tweets from the archive that match the request
+    """
+    archive_dir = os.path.dirname(index_fname)
+    if start_time is not None:
+        start_time = parse_utc_time(start_time)
+    if end_time is not None:
+        end_time = parse_utc_time(end_time)
+
+    with open(index_fname) as index_f:
+        for line in index_f:
+            entry = json.loads(line)
+            if tweet_id is not None:
+                if not int(entry['min_id']) <= int(tweet_id) <= int(entry['max_id']):
+                    continue
+            if entry['min_created_at'] is not None:
+                if (end_time is not None
+                    and parse_utc_time(entry['min_created_at']) >= end_time):
+                    continue
+                if (start_time is not None
+                    and parse_utc_time(entry['max_created_at']) < start_time):
+                    continue
+
+            segment_fname = os.path.join(archive_dir, entry['segment'])
+            with open(segment_fname, 'rb') as segment_f:
+                segment_f.seek(entry['offset'])
+                block = segment_f.read(entry['length'])
+            if segment_fname.endswith('.gz'):
+                block = gzip.decompress(block)
+            else:
+                if zstandard is None:
+                    raise ImportError("zstd compression requires the zstandard package")
+                block = zstandard.ZstdDecompressor().decompress(block)
+
+            for tweet_line in block.decode('utf-8').splitlines():
+                tweet = json.loads(tweet_line)
+                if tweet_id is not None and tweet['id'] != tweet_id:
+                    continue
+                if start_time is not None or end_time is not None:
+                    created_at = parse_utc_time(tweet['created_at'])
+                    if start_time is not None and created_at < start_time:
+                        continue
+                    if end_time is not None and created_at >= end_time:
+                        continue
+                yield tweet
+
+
+def parse_utc_time(time_str):
+    """
+    Parses a time, assuming that it is in UTC if no timezone is given
+
+    Parameters
+    ----------
+    time_str: str
+        The time to parse
+    """
+    parsed_time = parser.parse(time_str)
+    if parsed_time.tzinfo is None:
+        parsed_time = parsed_time.replace(tzinfo=timezone.utc)
+    return parsed_time
@@ -0,0 +1,459 @@
+import time
+import yaml
+import random
+import argparse
+import tracemalloc
+from dateutil import parser as dateparser
+from . import codec
+from .codec import json_dumps, json_loads
+from .helper import *
+
+
+# ------------------------------------------------------------------------------
+# ------------------------------ Payload functions -----------------------------
+# ------------------------------------------------------------------------------
+def make_response(n_tweets, heavy_includes=False, seed=0):
+    """
+    Makes a synthetic API v2 search response with the fields and expansions
+    requested by the listeners. Light responses have authors and a few
+    referenced tweets. Heavy responses also have mentions, URLs, hashtags,
+    media, and places on most tweets, and many referenced tweets
+
+    Parameters
+    ----------
+    n_tweets: int
+        The number of tweets in the `data` field of the response
+    heavy_includes: bool
+        Whether to make a response with heavy `includes`. Defaults to False
+    seed: int
+        Random seed, so that responses are reproducible
+
+    Returns
+    -------
+    response_json: dict
+        The synthetic response
+    """
+    rng = random.Random(seed)
+    n_users = max(1, n_tweets // 2)
+    users = [make_user(str(10**9 + u), rng, heavy_includes) for u in range(n_users)]
+    ref_prob = 0.8 if heavy_includes else 0.2
+
+    tweets = []
+    ref_tweets = []
+    media = []
+    places = []
+    for t in range(n_tweets):
+        author = rng.choice(users)
+        tweet = make_tweet(str(10**18 + t), author, rng, users, heavy_includes)
+        if rng.random() < ref_prob:
+            ref_author = rng.choice(users)
+            ref_tweet = make_tweet(str(10**17 + t), ref_author, rng, users,
+                                   heavy_includes)
+            ref_type = rng.choice(['retweeted', 'quoted', 'replied_to'])
+            tweet['referenced_tweets'] = [{'type': ref_type, 'id': ref_tweet['id']}]
+            ref_tweets.append(ref_tweet)
+        if heavy_includes and rng.random() < 0.5:
+            media_key = f"3_{10**18 + t}"
+            tweet['attachments'] = {'media_keys': [media_key]}
+            media.append({'media_key': media_key, 'type': 'photo', 'height': 1080,
+                          'width': 1920, 'public_metrics': {'view_count': t}})
+        if heavy_includes and rng.random() < 0.1:
+            place_id = f"{t:016x}"
+            tweet['geo'] = {'place_id': place_id}
+            places.append({'id': place_id, 'name': 'Place', 'full_name': 'Place, ST',
+                           'country': 'United States', 'country_code': 'US',
+                           'geo': {'type': 'Feature', 'bbox': [-1.0, -1.0, 1.0, 1.0],
+                                   'properties': {}},
+                           'place_type': 'city'})
+        tweets.append(tweet)
+
+    includes = {'users': users}
+    if len(ref_tweets) > 0:
+        includes['tweets'] = ref_tweets
+    if len(media) > 0:
+        includes['media'] = media
+    if len(places) > 0:
+        includes['places'] = places
+    meta = {'newest_id': tweets[0]['id'], 'oldest_id': tweets[-1]['id'],
+            'result_count': n_tweets, 'next_token': 'b26v89c19zqg8o3fpzbkk'}
+    response_json = {'data': tweets, 'includes': includes, 'meta': meta}
+    return response_json
+
+
+def make_tweet(tweet_id, author, rng, users, heavy):
+    """
+    Makes a single synthetic tweet object
+
+    Parameters
+    ----------
+    tweet_id: str
+        ID of the tweet
+    author: dict
+        User object of the tweet's author
+    rng: random.Random
+        Random number generator
+    users: list of dicts
+        User objects that can be mentioned
+    heavy: bool
+        Whether to add mentions, URLs, and hashtags
+    """
+    second = rng.randrange(86400)
+    created_at = f"2021-05-05T{second // 3600:02d}:{second // 60 % 60:02d}:{second % 60:02d}.000Z"
+    tweet = {'id': tweet_id,
+             'text': 'Synthetic tweet text ' * rng.randint(1, 12),
+             'lang': 'en',
+             'author_id': author['id'],
+             'conversation_id': tweet_id,
+             'created_at': created_at,
+             'possibly_sensitive': False,
+             'reply_settings': 'everyone',
+             'source': 'Twitter Web App',
+             'public_metrics': {'retweet_count': rng.randrange(1000),
+                                'reply_count': rng.randrange(100),
+                                'like_count': rng.randrange(5000),
+                                'quote_count': rng.randrange(50)}}
+    if heavy:
+        mentioned = rng.sample(users, min(len(users), 3))
+        tweet['entities'] = {
+            'mentions': [{'start': 0, 'end': 10, 'username': u['username'],
+                          'tag': u['username'], 'id': u['id']} for u in mentioned],
+            'hashtags': [{'start': 20, 'end': 30, 'tag': 'OversightBoard'}],
+            'urls': [{'start': 40, 'end': 63, 'url': 'https://t.co/abcdefghij',
+                      'expanded_url': 'https://example.com/article',
+                      'display_url': 'example.com/article'}]
+        }
+    return tweet
+
+
+def make_user(user_id, rng, heavy):
+    """
+    Makes a single synthetic user object
+
+    Parameters
+    ----------
+    user_id: str
+        ID of the user
+    rng: random.Random
+        Random number generator
+    heavy: bool
+        Whether to add description entities
+    """
+    user = {'id': user_id,
+            'name': f"User {user_id}",
+            'username': f"user{user_id}",
+            'created_at': '2012-03-04T05:06:07.000Z',
+            'description': 'Synthetic user description',
+            'location': 'Somewhere',
+            'profile_image_url': 'https://pbs.twimg.com/profile_images/1/a.jpg',
+            'verified': False,
+            'public_metrics': {'followers_count': rng.randrange(10**6),
+                               'following_count': rng.randrange(5000),
+                               'tweet_count': rng.randrange(10**5),
+                               'listed_count': rng.randrange(100)}}
+    if heavy:
+        user['entities'] = {
+            'url': {'urls': [{'expanded_url': 'https://example.com'}]},
+            'description': {'hashtags': [{'tag': 'research'}],
+                            'mentions': [{'tag': 'someone'}],
+                            'urls': [{'url': 'https://t.co/klmnopqrst',
+                                      'expanded_url': 'https://example.org'}]}
+        }
+    return user
+
+
+def load_responses(json_f):
+    """
+    Loads recorded API responses from a newline-delimited JSON file, one full
+    response per line. Responses can be search pages or stream messages, whose
+    single tweet is wrapped in a list. Responses without tweets are skipped
+
+    Parameters
+    ----------
+    json_f: str
+        Filename of the recorded responses
+
+    Returns
+    -------
+    response_jsons: list of dicts
+        The recorded responses
+    """
+    response_jsons = []
+    with open(json_f) as f_in:
+        for line in f_in:
+            if not line.strip():
+                continue
+            response_json = json_loads(line)
+            if 'data' not in response_json:
+                continue
+            if isinstance(response_json['data'], dict):
+                response_json['data'] = [response_json['data']]
+            response_jsons.append(response_json)
+    return response_jsons
+
+
+# ------------------------------------------------------------------------------
+# ----------------------------- Benchmark functions ----------------------------
+# ------------------------------------------------------------------------------
+def time_per_call(func, args_list, n_repeats):
+    """
+    Times a function over a list of arguments, in CPU time
+
+    Parameters
+    ----------
+    func: function
+        Function to time
+    args_list: list of tuples
+        Arguments to call the function with, one tuple per call
+    n_repeats: int
+        How many times to repeat all the calls. The fastest repeat is used
+
+    Returns
+    -------
+    n_secs: float
+        CPU seconds of the fastest repeat over all calls
+    """
+    best_secs = float('inf')
+    for _ in range(n_repeats):
+        start = time.process_time()
+        for args in args_list:
+            func(*args)
+        best_secs = min(best_secs, time.process_time() - start)
+    return best_secs
+
+
+def bench_codec(response_jsons, n_repeats):
+    """
+    Compares the CPU time per tweet of decoding responses and encoding tweets
+    with the stdlib json backend and the installed fast backends
+
+    Parameters
+    ----------
+    response_jsons: list of dicts
+        API responses to decode and whose tweets to encode
+    n_repeats: int
+        How many times to repeat each measurement
+    """
+    n_tweets = sum(len(r['data']) for r in response_jsons)
+    response_strs = [(json_dumps(r, backend='json'),) for r in response_jsons]
+    tweets = [(tweet,) for r in response_jsons for tweet in r['data']]
+
+    loads_backends = ['json']
+    if codec.simdjson is not None:
+        loads_backends.append('simdjson')
+    if codec.orjson is not None:
+        loads_backends.append('orjson')
+    dumps_backends = ['json']
+    if codec.orjson is not None:
+        dumps_backends.append('orjson')
+
+    print(f"\t{n_tweets:,} tweets in {len(response_jsons):,} responses")
+    for backend in loads_backends:
+        loads = lambda s: json_loads(s, backend=backend)
+        n_secs = time_per_call(loads, response_strs, n_repeats)
+        print(f"\tdecode  {backend:<9} {1e6 * n_secs / n_tweets:8.2f} us/tweet")
+    for backend in dumps_backends:
+        dumps = lambda t: json_dumps(t, backend=backend)
+        n_secs = time_per_call(dumps, tweets, n_repeats)
+        print(f"\tencode  {backend:<9} {1e6 * n_secs / n_tweets:8.2f} us/tweet")
+
+
+def bench_extraction(response_jsons, n_repeats, insert_fields):
+    """
+    Measures the throughput and memory of the extraction functions that run for
+    every tweet collected. Rows are put in the order of the config file's insert
+    fields, as the listeners do. Responses whose `includes` are missing any of
+    their tweets' authors cannot be extracted, so they are skipped
+
+    Parameters
+    ----------
+    response_jsons: list of dicts
+        API responses to extract insertion data from
+    n_repeats: int
+        How many times to repeat each measurement
+    insert_fields: dict
+        The `insert_fields.twitter` field of the config file
+    """
+    event = 'benchmark'
+    query_type = 'search'
+    pages = []
+    for r in response_jsons:
+        includes = r.get('includes', {})
+        author_ids = {u['id'] for u in includes.get('users', [])}
+        tweets = r['data'] + includes.get('tweets', [])
+        if all(t.get('author_id') in author_ids for t in tweets):
+            pages.append((r['data'], {'users': [], **includes}))
+    if len(pages) < len(response_jsons):
+        print(f"\tSkipped {len(response_jsons) - len(pages):,} responses without their authors")
+    if len(pages) == 0:
+        return
+    n_tweets = sum(len(tweets) for tweets,_ in pages)
+    n_users = sum(len(includes['users']) for _,includes in pages)
+
+    # Arguments for each function, one tuple per call
+    author_datas = [get_author_data(includes) for _,includes in pages]
+    ref_relation_args = []
+    for (tweets,_),(ref_id2author_id,author_id2n_followers,handle2author_id) in zip(pages, author_datas):
+        author_id2handle = {a_id:h for h,a_id in handle2author_id.items()}
+        ref_relation_args.append((tweets, ref_id2author_id, author_id2n_followers,
+                                  author_id2handle))
+    tweet_insert_args = []
+    for (tweets,_),(_,author_id2n_followers,handle2author_id) in zip(pages, author_datas):
+        author_id2handle = {a_id:h for h,a_id in handle2author_id.items()}
+        tweet_insert_args.extend((t, event, query_type, True, author_id2handle,
+                                  author_id2n_followers, handle2author_id)
+                                 for t in tweets)
+    row_getters = {insert_type: get_row_getter(list(fields.keys()),
+                                               INSERT_TYPE2FIELDS[insert_type])
+                   for insert_type,fields in insert_fields.items()}
+    row_getters['ref'] = row_getters['tweets']
+    func_args = [
+        ('get_all_inserts', get_all_inserts,
+         [(tweets, includes, event, query_type, row_getters) for tweets,includes in pages],
+         n_tweets),
+        ('get_author_data', get_author_data,
+         [(includes,) for _,includes in pages], n_tweets),
+        ('get_ref_relations', get_ref_relations, ref_relation_args, n_tweets),
+        ('get_tweet_insert', get_tweet_insert, tweet_insert_args, n_tweets),
+        ('get_user_insert', get_user_insert,
+         [(u, event) for _,includes in pages for u in includes['users']], n_users),
+    ]
+
+    print(f"\t{'function':<18} {'objs/sec':>12} {'us/obj':>9} {'peak KB/page':>13}")
+    for name,func,args_list,n_objs in func_args:
+        n_secs = time_per_call(func, args_list, n_repeats)
+        peak_kb = get_peak_kb(func, args_list) / len(pages)
+        print(f"\t{name:<18} {n_objs / n_secs:>12,.0f} {1e6 * n_secs / n_objs:>9.2f} {peak_kb:>13.1f}")
+
+
+def bench_timestamps(response_jsons, n_repeats):
+    """
+    Compares the CPU time of parsing the `created_at` times of tweets and users
+    with dateutil and with `parse_time`
+
+    Parameters
+    ----------
+    response_jsons: list of dicts
+        API responses whose times to parse
+    n_repeats: int
+        How many times to repeat each measurement
+    """
+    time_strs = []
+    for r in response_jsons:
+        time_strs.extend((t['created_at'],) for t in r['data'])
+        includes = r.get('includes', {})
+        for include_type in ['tweets', 'users']:
+            time_strs.extend((o['created_at'],) for o in includes.get(include_type, []))
+
+    dateutil_secs = time_per_call(dateparser.parse, time_strs, n_repeats)
+    parse_time_to_second.cache_clear()
+    fast_secs = time_per_call(parse_time, time_strs, n_repeats)
+    n_times = len(time_strs)
+    print(f"\t{n_times:,} times")
+    print(f"\tdateutil    {1e6 * dateutil_secs / n_times:8.2f} us/time")
+    print(f"\tparse_time  {1e6 * fast_secs / n_times:8.2f} us/time")
+    print(f"\tspeedup     {dateutil_secs / fast_secs:8.1f}x")
+
+
+def get_peak_kb(func, args_list):
+    """
+    Measures the total of the peak memory allocated by each call of a function
+
+    Parameters
+    ----------
+    func: function
+        Function to measure
+    args_list: list of tuples
+        Arguments to call the function with, one tuple per call
+
+    Returns
+    -------
+    peak_kb: float
+        Sum over all calls of the peak kilobytes allocated during the call
+    """
+    peak_kb = 0
+    tracemalloc.start()
+    for args in args_list:
+        tracemalloc.reset_peak()
+        start_size,_ = tracemalloc.get_traced_memory()
+        func(*args)
+        _,peak_size = tracemalloc.get_traced_memory()
+        peak_kb += (peak_size - start_size) / 1024
+    tracemalloc.stop()
+    return peak_kb
+
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+def main(benchmark, config_f, json_f, n_tweets, page_sizes, includes, n_repeats):
+    """
+    Runs a benchmark on recorded API responses if given, otherwise on synthetic
+    responses of each page size with light and/or heavy `includes`
+
+    Parameters
+    ----------
+    benchmark: str
+        Which benchmark to run: "codec", "extraction", or "timestamps"
+    config_f: str
+        The configuration file to use for the insert fields
+    json_f: str
+        Filename of recorded API responses, one full response per line
+    n_tweets: int
+        Number of tweets across all synthetic responses of one page size
+    page_sizes: list of ints
+        Numbers of tweets per synthetic response
+    includes: str
+        Whether synthetic responses have "light" or "heavy" `includes`, or
+        "both" to benchmark each
+    n_repeats: int
+        How many times to repeat each measurement
+    """
+    with open(config_f) as fin:
+        config = yaml.load(fin, Loader=yaml.Loader)
+    insert_fields = config['insert_fields']['twitter']
+
+    if json_f is not None:
+        fixtures = [(json_f, load_responses(json_f))]
+    else:
+        if includes == 'both':
+            heavies = [False, True]
+        else:
+            heavies = [includes == 'heavy']
+        fixtures = []
+        for page_size in page_sizes:
+            n_pages = max(1, n_tweets // page_size)
+            for heavy in heavies:
+                label = f"{page_size} tweets/page, {'heavy' if heavy else 'light'} includes"
+                response_jsons = [make_response(page_size, heavy, seed=p)
+                                  for p in range(n_pages)]
+                fixtures.append((label, response_jsons))
+
+    for label,response_jsons in fixtures:
+        print(f"\n{label}")
+        if benchmark == 'codec':
+            bench_codec(response_jsons, n_repeats)
+        elif benchmark == 'extraction':
+            bench_extraction(response_jsons, n_repeats, insert_fields)
+        elif benchmark == 'timestamps':
+            bench_timestamps(response_jsons, n_repeats)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks of data handling")
+    parser.add_argument("benchmark", type=str, choices=['codec', 'extraction', 'timestamps'])
+    parser.add_argument("-config_f", type=str, default="config.yaml")
+    parser.add_argument("-json_f", type=str, default=None)
+    parser.add_argument("-n_tweets", type=int, default=5000)
+    parser.add_argument("-page_sizes", type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument("-includes", type=str, default="both",
+                        choices=['light', 'heavy', 'both'])
+    parser.add_argument("-n_repeats", type=int, default=5)
+
+    args = parser.parse_args()
+
+    main(args.benchmark,
+         args.config_f,
+         args.json_f,
+         args.n_tweets,
+         args.page_sizes,
+         args.includes,
+         args.n_repeats)
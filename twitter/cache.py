@@ -0,0 +1,119 @@
+import time
+from collections import OrderedDict
+
+
+class UpdateCache():
+    """
+    Least-recently-used cache of the objects (e.g. users or media) that have
+    been written to the database, keyed by ID. For each object, it remembers
+    the values of the fields that get updated on conflict (e.g. `public_metrics`
+    counts) and when they were written. Users and media reappear on nearly
+    every page of conversation and timeline searches, and rewriting them only
+    matters if one of those fields changed, since no other field is updated
+
+    Parameters
+    ----------
+    update_fields: list of strs
+        Fields of the table that are updated on conflict. `inserted_at` and
+        `last_updated_at` are ignored since they change on every write
+    row_fields: list of strs
+        Fields of the rows that are checked, in order, e.g. `USER_FIELDS`
+    size: int
+        The maximum number of objects to remember. Defaults to 100,000
+    max_age_mins: float
+        How many minutes before an object is rewritten even if nothing changed,
+        which keeps `last_updated_at` roughly current. Defaults to 60
+    """
+    def __init__(self,
+                 update_fields,
+                 row_fields,
+                 size=100000,
+                 max_age_mins=60):
+        self.fields = [f for f in update_fields
+                       if f not in {'inserted_at', 'last_updated_at'}]
+        self.id_index = row_fields.index('id')
+        self.field_indices = [row_fields.index(f) for f in self.fields]
+        self.size = size
+        self.max_age_secs = 60 * max_age_mins
+        self.id2written = OrderedDict()
+        self.n_hits = 0
+        self.n_misses = 0
+
+
+    def should_write(self, insert):
+        """
+        Checks whether an object needs to be written, i.e. it has not been
+        written before, one of its update fields changed, or it was last written
+        too long ago. If so, remembers it as written
+
+        Parameters
+        ----------
+        insert: tuple
+            Row of insertion data of the object, e.g. from `get_user_insert`
+
+        Returns
+        -------
+        write: bool
+            Whether to write the object
+        """
+        insert_id = insert[self.id_index]
+        values = tuple(insert[i] for i in self.field_indices)
+        now = time.time()
+        if insert_id in self.id2written:
+            prev_values,prev_write_time = self.id2written[insert_id]
+            self.id2written.move_to_end(insert_id)
+            if prev_values == values and now - prev_write_time < self.max_age_secs:
+                self.n_hits += 1
+                return False
+
+        self.n_misses += 1
+        self.id2written[insert_id] = (values, now)
+        self.id2written.move_to_end(insert_id)
+        if len(self.id2written) > self.size:
+            self.id2written.popitem(last=False)
+        return True
+
+
+class SeenSet():
+    """
+    Least-recently-used set of IDs, bounded in size. Used for objects that are
+    never updated once inserted, like referenced tweets, where any repeat
+    insert does nothing. IDs are kept exactly rather than in a probabilistic
+    filter so that a false positive can never drop a new object
+
+    Parameters
+    ----------
+    size: int
+        The maximum number of IDs to remember. Defaults to 1,000,000
+    """
+    def __init__(self, size=1000000):
+        self.size = size
+        self.ids = OrderedDict()
+        self.n_hits = 0
+        self.n_misses = 0
+
+
+    def add(self, seen_id):
+        """
+        Adds an ID to the set
+
+        Parameters
+        ----------
+        seen_id: str
+            ID to add
+
+        Returns
+        -------
+        is_new: bool
+            Whether the ID was not already in the set
+        """
+        if seen_id in self.ids:
+            self.ids.move_to_end(seen_id)
+            self.n_hits += 1
+            return False
+
+        self.n_misses += 1
+        self.ids[seen_id] = None
+        if len(self.ids) > self.size:
+            self.ids.popitem(last=False)
+        return True
@@ -0,0 +1,75 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+# Fastest installed backends for encoding and decoding JSON. orjson is used for
+# both if it is installed, simdjson only decodes, and json is the fallback
+if orjson is not None:
+    dumps_backend = 'orjson'
+    loads_backend = 'orjson'
+elif simdjson is not None:
+    dumps_backend = 'json'
+    loads_backend = 'simdjson'
+else:
+    dumps_backend = 'json'
+    loads_backend = 'json'
+
+
+def json_dumps(obj, backend=None):
+    """
+    Encodes an object as a JSON string
+
+    Parameters
+    ----------
+    obj:
+        Object to encode
+    backend: str
+        The JSON library to use, "orjson" or "json". Defaults to the fastest
+        one installed
+
+    Returns
+    -------
+    json_str: str
+        The JSON string of the object
+    """
+    if backend is None:
+        backend = dumps_backend
+    if backend == 'orjson':
+        return orjson.dumps(obj).decode('utf-8')
+    else:
+        return json.dumps(obj)
+
+
+def json_loads(json_str, backend=None):
+    """
+    Decodes a JSON string or bytes, e.g. the content of a response or a line
+    of the stream
+
+    Parameters
+    ----------
+    json_str: str or bytes
+        JSON to decode
+    backend: str
+        The JSON library to use, "orjson", "simdjson", or "json". Defaults to
+        the fastest one installed
+
+    Returns
+    -------
+    obj:
+        The decoded object
+    """
+    if backend is None:
+        backend = loads_backend
+    if backend == 'orjson':
+        return orjson.loads(json_str)
+    elif backend == 'simdjson':
+        return simdjson.loads(json_str)
+    else:
+        return json.loads(json_str)
@@ -1,7 +1,48 @@
-import json
+import io
+import re
+import math
+import hashlib
+import heapq
+import warnings
+import requests
 from dateutil import parser
 from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from operator import itemgetter
+from functools import lru_cache
 from psycopg2.extras import Json
+from requests.adapters import HTTPAdapter
+from .codec import json_dumps
+
+# ------------------------------------------------------------------------------
+# ----------------------------- Connection functions ---------------------------
+# ------------------------------------------------------------------------------
+def get_session(pool_size=10):
+    """
+    Creates an HTTP session for making API calls. The session keeps connections
+    alive and pools them, so that repeated calls to the same endpoint do not
+    each have to make a new connection, and asks for compressed responses
+
+    Parameters
+    ----------
+    pool_size: int
+        The maximum number of connections to keep open per host. Should be at
+        least the number of requests made concurrently. Defaults to 10
+
+    Returns
+    -------
+    session: requests.Session
+        The session to make API calls with
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                            'Connection': 'keep-alive'})
+    return session
+
 
 # ------------------------------------------------------------------------------
 # ------------------------- Database / writing functions -----------------------
@@ -33,7 +74,9 @@ def get_update_cmd(update_fields, query_type, insert_type):
 def get_insert_cmd(insert_fields, table, update_cmd=None):
     """
     Creates the insert command to use with an insertion to a PostgreSQL database,
-    given the table and the fields to be inserted
+    given the table and the fields to be inserted. The template is positional,
+    so rows are inserted as tuples of values in the order of the fields (see
+    `get_all_inserts`)
 
     Parameters
     ----------
@@ -54,9 +97,9 @@ def get_insert_cmd(insert_fields, table, update_cmd=None):
     template_strs = []
     for f in insert_fields:
         if f in json_array_fields:
-            s = f"%({f})s::jsonb[]"
+            s = "%s::jsonb[]"
         else:
-            s = f"%({f})s"
+            s = "%s"
         template_strs.append(s)
     template_str = ','.join(template_strs)
     template = f"({template_str})"
@@ -64,10 +107,324 @@ def get_insert_cmd(insert_fields, table, update_cmd=None):
     return insert_cmd,template
 
 
+def get_row_getter(insert_fields, row_fields):
+    """
+    Creates a function that puts the values of an extracted row in the order of
+    the insert fields. The extraction functions build rows directly as tuples
+    of the fields they extract (see `TWEET_FIELDS`), which the insert fields of
+    the default config file match, so most rows need no conversion at all
+
+    Parameters
+    ----------
+    insert_fields: list of strs
+        Fields of data that will be inserted, in column order
+    row_fields: list of strs
+        Fields of the extracted rows, in order
+
+    Returns
+    -------
+    row_getter: function
+        Function that takes an extracted row and returns its insert row, or
+        None if the rows are already in the order of the insert fields
+    """
+    if list(insert_fields) == list(row_fields):
+        return None
+    unknown_fields = [f for f in insert_fields if f not in row_fields]
+    if len(unknown_fields) > 0:
+        raise ValueError(f"Insert fields that are not extracted: {unknown_fields}")
+    indices = [row_fields.index(f) for f in insert_fields]
+    if len(indices) == 1:
+        # itemgetter only returns a tuple for more than one field
+        index = indices[0]
+        return lambda row: (row[index],)
+    return itemgetter(*indices)
+
+
+def get_stage_cmd(table, stage_table):
+    """
+    Creates the command for making a temporary staging table that mirrors the
+    columns of a table. Rows are copied into the staging table before being
+    merged into the table itself. Temporary tables are not written to the
+    write-ahead log, so staging into them is cheap
+
+    Parameters
+    ----------
+    table: str
+        Name of the table that the staging table mirrors
+    stage_table: str
+        Name of the staging table to create
+    """
+    stage_cmd = f"""
+    CREATE TEMP TABLE IF NOT EXISTS {stage_table} (
+        LIKE {table} INCLUDING DEFAULTS,
+        stage_seq BIGSERIAL
+    )
+    """
+    return stage_cmd
+
+
+def get_merge_cmd(insert_fields, table, stage_table, update_cmd=None):
+    """
+    Creates the command for merging rows from a staging table into a table,
+    with the same conflict handling as the command from `get_insert_cmd`. If
+    the same ID and event were staged more than once, only the most recently
+    staged row is merged, as if the rows had been inserted one after another
+
+    Parameters
+    ----------
+    insert_fields: list of strs
+        Fields of data that will be inserted
+    table: str
+        Name of the table being inserted into
+    stage_table: str
+        Name of the staging table rows are selected from
+    update_cmd:
+        Update command to use when there is a conflict on the ID and event keys.
+        If `None`, then defaults to "DO NOTHING" and no update is performed
+    """
+    if update_cmd is None:
+        update_cmd = "DO NOTHING"
+    insert_str = ','.join(insert_fields)
+    merge_cmd = f"""
+    INSERT INTO {table} ({insert_str})
+    SELECT DISTINCT ON (id,event) {insert_str}
+    FROM {stage_table}
+    ORDER BY id, event, stage_seq DESC
+    ON CONFLICT (id,event) {update_cmd}
+    """
+    return merge_cmd
+
+
+def get_partition_cmd(table, event):
+    """
+    Creates the command for creating the partition of an event in a table that
+    is partitioned by event. Partition names are made from the event name and
+    a hash of it, so that events that only differ in punctuation or case do not
+    share a name
+
+    Parameters
+    ----------
+    table: str
+        Name of the partitioned table, including its schema
+    event: str
+        Name of the event
+
+    Returns
+    -------
+    partition_cmd: str
+        Command to run with the event as the `event` parameter
+    """
+    event_str = re.sub(r'[^a-z0-9_]', '_', event.lower())[:32]
+    event_hash = hashlib.md5(event.encode('utf-8')).hexdigest()[:8]
+    partition = f"{table}_{event_str}_{event_hash}"
+    partition_cmd = f"""
+    CREATE TABLE IF NOT EXISTS {partition}
+    PARTITION OF {table} FOR VALUES IN (%(event)s)
+    """
+    return partition_cmd
+
+
+def get_copy_buffer(rows):
+    """
+    Formats rows of insertion data as PostgreSQL `COPY` text, one line per row
+
+    Parameters
+    ----------
+    rows: list of tuples
+        Rows of insertion data, with values in column order (see
+        `get_all_inserts`)
+
+    Returns
+    -------
+    copy_buffer: io.StringIO
+        File-like object of the copy text, to pass to `cursor.copy_expert`
+    """
+    lines = []
+    for row in rows:
+        lines.append('\t'.join([format_copy_value(v) for v in row]))
+    copy_buffer = io.StringIO('\n'.join(lines) + '\n' if lines else '')
+    return copy_buffer
+
+
+def format_copy_value(value):
+    """
+    Formats a single value as a field of PostgreSQL `COPY` text
+
+    Parameters
+    ----------
+    value:
+        Value to format. Lists are formatted as PostgreSQL array literals
+
+    Returns
+    -------
+    copy_str: str
+        The value escaped for use in `COPY` text, or `\\N` if the value is None
+    """
+    if value is None:
+        return '\\N'
+    elif isinstance(value, (list, tuple)):
+        elements = []
+        for v in value:
+            if v is None:
+                elements.append('NULL')
+            else:
+                v = format_copy_str(v).replace('\\', '\\\\').replace('"', '\\"')
+                elements.append(f'"{v}"')
+        copy_str = '{' + ','.join(elements) + '}'
+    else:
+        copy_str = format_copy_str(value)
+    copy_str = (copy_str.replace('\\', '\\\\')
+                        .replace('\n', '\\n')
+                        .replace('\r', '\\r')
+                        .replace('\t', '\\t'))
+    return copy_str
+
+
+def format_copy_str(value):
+    """
+    Converts a single non-null, non-array value to its PostgreSQL text form
+
+    Parameters
+    ----------
+    value:
+        Value to convert
+    """
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, datetime):
+        return value.isoformat()
+    elif isinstance(value, Json):
+        return json_dumps(value.adapted)
+    else:
+        return str(value)
+
+
 # ------------------------------------------------------------------------------
 # ---------------------------- Extraction functions ----------------------------
 # ------------------------------------------------------------------------------
-def get_all_inserts(tweets, includes, event, query_type):
+# Query types that tweets can come from, in the order of their source flags
+QUERY_TYPES = ['search', 'stream', 'convo_search', 'quote_search', 'timeline_search']
+# Fields of the rows built by each extraction function, in order. These match
+# the order of the insert fields in the default config file
+TWEET_FIELDS = (
+    ['id', 'event', 'inserted_at', 'last_updated_at']
+    + [f for query_type in QUERY_TYPES
+       for f in [f"from_{query_type}", f"directly_from_{query_type}"]]
+    + ['text', 'lang', 'author_id', 'author_handle', 'created_at',
+       'conversation_id', 'possibly_sensitive', 'reply_settings', 'source',
+       'author_follower_count', 'retweet_count', 'reply_count', 'like_count',
+       'quote_count']
+    + [f for ref_type in ['replied_to', 'quoted', 'retweeted']
+       for f in [ref_type, f"{ref_type}_author_id", f"{ref_type}_handle",
+                 f"{ref_type}_follower_count"]]
+    + ['mentioned_author_ids', 'mentioned_handles', 'hashtags', 'urls',
+       'media_keys', 'place_id']
+)
+USER_FIELDS = ['id', 'event', 'inserted_at', 'last_updated_at', 'name',
+               'username', 'created_at', 'description', 'location',
+               'pinned_tweet_id', 'followers_count', 'following_count',
+               'tweet_count', 'url', 'profile_image_url', 'description_urls',
+               'description_hashtags', 'description_mentions', 'verified']
+MEDIA_FIELDS = ['id', 'event', 'inserted_at', 'last_updated_at', 'type',
+                'duration_ms', 'height', 'width', 'preview_image_url',
+                'view_count']
+PLACE_FIELDS = ['id', 'event', 'inserted_at', 'last_updated_at', 'name',
+                'full_name', 'country', 'country_code', 'geo', 'place_type']
+INSERT_TYPE2FIELDS = {'tweets': TWEET_FIELDS,
+                      'ref': TWEET_FIELDS,
+                      'users': USER_FIELDS,
+                      'media': MEDIA_FIELDS,
+                      'places': PLACE_FIELDS}
+
+
+def parse_time(time_str):
+    """
+    Parses a time returned by the API into a UTC-aware datetime. The API always
+    returns times as YYYY-MM-DDTHH:MM:SS.sssZ, which is parsed directly. Any
+    other format falls back to the generic (and much slower) dateutil parser
+
+    Parameters
+    ----------
+    time_str: str
+        The time to parse, e.g. the `created_at` field of a tweet or user
+
+    Returns
+    -------
+    parsed_time: datetime
+        The parsed time
+    """
+    if len(time_str) == 24 and time_str[19] == '.' and time_str[23] == 'Z':
+        parsed_time = parse_time_to_second(time_str[:19])
+        milliseconds = time_str[20:23]
+        if milliseconds != '000':
+            parsed_time = parsed_time.replace(microsecond=1000*int(milliseconds))
+        return parsed_time
+    return parser.parse(time_str)
+
+
+@lru_cache(maxsize=4096)
+def parse_time_to_second(time_str):
+    """
+    Parses a YYYY-MM-DDTHH:MM:SS time in UTC. Cached because many tweets are
+    created in the same second during bursts of activity
+
+    Parameters
+    ----------
+    time_str: str
+        The time to parse
+    """
+    return datetime.fromisoformat(time_str).replace(tzinfo=timezone.utc)
+
+
+def merge_responses(response_jsons):
+    """
+    Merges several API responses into a single response, so that they can be
+    written all at once. Tweets and included objects that appear in more than
+    one response are only kept once, using their most recent version
+
+    Parameters
+    ----------
+    response_jsons: list of dicts
+        JSON from API responses. The `data` field can be either a list of
+        tweets (search) or a single tweet (stream)
+
+    Returns
+    -------
+    response_json: dict
+        A response with a `data` field of all tweets and an `includes` field of
+        all included objects
+    """
+    id2tweet = dict()
+    include_type2id2obj = dict()
+    for response_json in response_jsons:
+        try:
+            tweets = response_json['data']
+        except KeyError:
+            # Stream errors are surfaced by the reader before they are queued
+            warnings.warn(f"Skipping response without tweets: {response_json}")
+            continue
+        if isinstance(tweets, dict):
+            tweets = [tweets]
+        for tweet in tweets:
+            id2tweet[tweet['id']] = tweet
+
+        if 'includes' not in response_json:
+            continue
+        for include_type,objs in response_json['includes'].items():
+            if include_type not in include_type2id2obj:
+                include_type2id2obj[include_type] = dict()
+            id_field = 'media_key' if include_type == 'media' else 'id'
+            for obj in objs:
+                include_type2id2obj[include_type][obj[id_field]] = obj
+
+    includes = {include_type:list(id2obj.values())
+                for include_type,id2obj in include_type2id2obj.items()}
+    response_json = {'data': list(id2tweet.values()), 'includes': includes}
+    return response_json
+
+
+def get_all_inserts(tweets, includes, event, query_type, row_getters=None,
+                    caches=None):
     """
     Gets all the data for insertion into a PostgreSQL database from a set of
     tweets. This includes insertion data for the tweets, the tweets' authors,
@@ -93,15 +450,34 @@ def get_all_inserts(tweets, includes, event, query_type):
     query_type: str
         The type of API query: either "stream", "search", "convo_search", or
         "timeline_search"
+    row_getters: dict of functions
+        If given, dictionary mapping insert types ("tweets", "ref", "users",
+        "media", "places") to functions from `get_row_getter`, which put rows
+        in the order of the insert fields. Insert types that are missing or
+        map to None keep the order they were extracted in. Defaults to None
+    caches: dict
+        If given, dictionary that may map "users" and "media" to an
+        `UpdateCache`, and "ref" to a `SeenSet`. These persist across pages, so
+        users and media are only inserted if they are new or their update fields
+        changed, and referenced tweets are only inserted if they have not been
+        seen before. Defaults to None, which inserts everything
 
     Returns
     -------
-    tweet_inserts, ref_inserts, user_inserts, media_inserts, place_inserts: lists of dicts
-        Lists of dictionaries that contain the insertion data. There is one list
-        each for tweets originally from the query, tweets referenced by those in
-        the query, all authors of both those sets of tweets, any media
-        referenced in those tweets, and any places data linked to those tweets
+    tweet_inserts, ref_inserts, user_inserts, media_inserts, place_inserts: lists of tuples
+        Lists of rows that contain the insertion data. There is one list each
+        for tweets originally from the query, tweets referenced by those in the
+        query, all authors of both those sets of tweets, any media referenced
+        in those tweets, and any places data linked to those tweets
     """
+    if caches is None:
+        caches = dict()
+    user_cache = caches.get('users')
+    media_cache = caches.get('media')
+    ref_seen = caches.get('ref')
+    if row_getters is None:
+        row_getters = dict()
+
     # Get referenced tweet info about authors
     ref_id2author_id,author_id2n_followers,handle2author_id = get_author_data(includes)
     author_id2handle = {a_id:handle for handle,a_id in handle2author_id.items()}
@@ -113,27 +489,17 @@ def get_all_inserts(tweets, includes, event, query_type):
     tweet_ids = set()
     tweet_inserts = []
     for tweet in tweets:
-        # Get basic insertation data of tweet
-        tweet_insert = get_tweet_insert(tweet, event, query_type, direct=True)
         tweet_id = tweet['id']
         tweet_ids.add(tweet_id)
-        # Update with mentioned users
-        try:
-            mentioned = [m['tag'] for m in tweet['entities']['mentions']]
-            mentioned_author_ids = [handle2author_id[h] for h in mentioned]
-            tweet_insert['mentioned_handles'] = mentioned
-            tweet_insert['mentioned_author_ids'] = mentioned_author_ids
-        except KeyError:
-            tweet_insert['mentioned_handles'] = None
-            tweet_insert['mentioned_author_ids'] = None
-        # Update with other info
-        tweet_insert['author_handle'] = author_id2handle[tweet['author_id']]
-        tweet_insert['author_follower_count'] = author_id2n_followers[tweet['author_id']]
-        # Update with information about all of its referenced authors
-        ref_type2author = tweet_id2ref_type2author[tweet_id]
-        ref_type2n_followers = tweet_id2ref_type2n_followers[tweet_id]
-        ref_authors_insert = update_w_ref_author_data(ref_type2author, ref_type2n_followers)
-        tweet_insert.update(ref_authors_insert)
+        if ref_seen is not None:
+            # Tweets already in the table never need a referenced tweet insert
+            ref_seen.add(tweet_id)
+        # Includes information about all of its referenced authors
+        tweet_insert = get_tweet_insert(tweet, event, query_type, True,
+                                        author_id2handle, author_id2n_followers,
+                                        handle2author_id,
+                                        tweet_id2ref_type2author[tweet_id],
+                                        tweet_id2ref_type2n_followers[tweet_id])
         tweet_inserts.append(tweet_insert)
 
     # Get insert data for referenced tweets
@@ -143,23 +509,20 @@ def get_all_inserts(tweets, includes, event, query_type):
             if tweet['id'] in tweet_ids:
                 # Don't make duplicate inserts for efficency
                 continue
-            ref_insert = get_tweet_insert(tweet, event, query_type, direct=False)
-            try:
-                mentioned = [m['tag'] for m in tweet['entities']['mentions']]
-                mentioned_author_ids = [handle2author_id[h] for h in mentioned]
-                ref_insert['mentioned_handles'] = mentioned
-                ref_insert['mentioned_author_ids'] = mentioned_author_ids
-            except KeyError:
-                ref_insert['mentioned_handles'] = None
-                ref_insert['mentioned_author_ids'] = None
-            ref_insert['author_handle'] = author_id2handle[tweet['author_id']]
-            ref_insert['author_follower_count'] = author_id2n_followers[tweet['author_id']]
+            if ref_seen is not None and not ref_seen.add(tweet['id']):
+                # Already inserted on an earlier page or message
+                continue
+            ref_insert = get_tweet_insert(tweet, event, query_type, False,
+                                          author_id2handle, author_id2n_followers,
+                                          handle2author_id)
             ref_inserts.append(ref_insert)
 
     # Get insert data for users
     user_inserts = []
     for user in includes['users']:
         user_insert = get_user_insert(user, event)
+        if user_cache is not None and not user_cache.should_write(user_insert):
+            continue
         user_inserts.append(user_insert)
 
     # Get media inserts
@@ -167,14 +530,16 @@ def get_all_inserts(tweets, includes, event, query_type):
     if 'media' in includes:
         seen_ids = set()
         for media in includes['media']:
-            media_insert = get_media_insert(media, event)
             # Not sure why this is necessary but `includes` can have duplicate
             # entries for media? Which messes up DB insertion. Might have
             # somthing to do with different view_counts
-            if media_insert['id'] in seen_ids:
+            if media['media_key'] in seen_ids:
                 continue
             else:
-                seen_ids.add(media_insert['id'])
+                seen_ids.add(media['media_key'])
+            media_insert = get_media_insert(media, event)
+            if media_cache is not None and not media_cache.should_write(media_insert):
+                continue
 
             media_inserts.append(media_insert)
 
@@ -182,10 +547,19 @@ def get_all_inserts(tweets, includes, event, query_type):
     place_inserts = []
     if 'places' in includes:
         for place in includes['places']:
-            place_insert = get_place_insert(place, event)
-            place_inserts.append(place_insert)
+            place_inserts.append(get_place_insert(place, event))
 
-    return tweet_inserts,ref_inserts,user_inserts,media_inserts,place_inserts
+    # Put rows in the order of the insert fields, if it differs
+    all_inserts = []
+    insert_types = ['tweets', 'ref', 'users', 'media', 'places']
+    for insert_type,inserts in zip(insert_types, [tweet_inserts, ref_inserts, user_inserts,
+                                                  media_inserts, place_inserts]):
+        row_getter = row_getters.get(insert_type)
+        if row_getter is not None:
+            inserts = [row_getter(insert) for insert in inserts]
+        all_inserts.append(inserts)
+
+    return tuple(all_inserts)
 
 
 def get_author_data(includes):
@@ -298,37 +672,58 @@ def get_ref_relations(tweets, ref_id2author_id, author_id2n_followers,
     return tweet_id2ref_type2author, tweet_id2ref_type2n_followers
 
 
-def update_w_ref_author_data(ref_type2author, ref_type2n_followers):
+@lru_cache(maxsize=None)
+def get_source_flags(query_type, direct):
     """
-    Update a tweet insert with information about its referenced tweets authors
+    Gets the values of the `from_*` and `directly_from_*` fields of a tweet, in
+    the order of `QUERY_TYPES`
 
     Parameters
     ----------
-    ref_type2author: dict
-        Dictionary where keys are types of references made in the tweet
-        (e.g. "quoted") and values are tuples of the author IDs and handles of
-        the referenced tweets
-    ref_type2n_followers: dict
-        Dictionary where keys are types of references made in the tweet
-        (e.g. "quoted") and values are the number of followers of the authors of
-        the referenced tweets
+    query_type: str
+        The type of query the tweet was retrieved from
+    direct: bool
+        Whether the tweet came directly from the query or not
+
     Returns
     -------
-    ref_authors_insert: dict
-        Dictionary for updating the referenced authors information of the tweet
-        being inserted (e.g. keys like "quoted_author_id" and
-        "quoted_follower_count")
+    source_flags: tuple of bools
+        The `from_*` and `directly_from_*` value of each query type
+    """
+    source_flags = []
+    for source in QUERY_TYPES:
+        source_flags.append(source == query_type)
+        source_flags.append(source == query_type and direct)
+    return tuple(source_flags)
+
+
+def get_clean_str(obj, field):
     """
-    ref_authors_insert = dict()
-    for ref,(author_id,handle) in ref_type2author.items():
-        ref_authors_insert[f"{ref}_handle"] = handle
-        ref_authors_insert[f"{ref}_author_id"] = author_id
-        ref_authors_insert[f"{ref}_follower_count"] = ref_type2n_followers[ref]
+    Gets a string field of an API object with any null characters removed,
+    which PostgreSQL cannot store
+
+    Parameters
+    ----------
+    obj: dict
+        Dictionary object from the API, e.g. a user
+    field: str
+        The field to get
 
-    return ref_authors_insert
+    Returns
+    -------
+    clean_str: str
+        The string without null characters, or None if the object does not
+        have the field
+    """
+    try:
+        return obj[field].replace('\x00', '')
+    except KeyError:
+        return None
 
 
-def get_tweet_insert(tweet, event, query_type, direct):
+def get_tweet_insert(tweet, event, query_type, direct, author_id2handle,
+                     author_id2n_followers, handle2author_id,
+                     ref_type2author=None, ref_type2n_followers=None):
     """
     Gets all the insertion data for a single tweet
 
@@ -336,12 +731,6 @@ def get_tweet_insert(tweet, event, query_type, direct):
     ----------
     tweet: dict
         Dictionary object of a tweet
-
-    Returns
-    -------
-    tweet_insert: dict
-        Dictionary of values extracted and formatted for insertion into a
-        PostgreSQL database
     event: str
         Event name of query the tweet was retrieved from
     query_type: str
@@ -349,11 +738,33 @@ def get_tweet_insert(tweet, event, query_type, direct):
     direct: str
         Whether the tweet came directly from the query or not, i.e. is the tweet
         a referenced tweet or not
+    author_id2handle: dict
+        Dictionary mapping author IDs to handles, from `get_author_data`
+    author_id2n_followers: dict
+        Dictionary mapping author IDs to their number of followers, from
+        `get_author_data`
+    handle2author_id: dict
+        Dictionary mapping handles to author IDs, from `get_author_data`
+    ref_type2author: dict
+        Dictionary mapping types of references made in the tweet (e.g.
+        "quoted") to the author IDs and handles of the referenced tweets, from
+        `get_ref_relations`. Defaults to None, which leaves the referenced
+        authors unset
+    ref_type2n_followers: dict
+        Dictionary mapping types of references made in the tweet to the number
+        of followers of the authors of the referenced tweets, from
+        `get_ref_relations`
+
+    Returns
+    -------
+    tweet_insert: tuple
+        Values extracted and formatted for insertion into a PostgreSQL
+        database, in the order of `TWEET_FIELDS`
     """
     # URLs
     try:
         urls = tweet['entities']['urls']
-        urls = [json.dumps(url) for url in urls]
+        urls = [json_dumps(url) for url in urls]
     except KeyError:
         urls = None
     # Hashtags
@@ -361,6 +772,13 @@ def get_tweet_insert(tweet, event, query_type, direct):
         hashtags = [hashtag_info['tag'] for hashtag_info in tweet['entities']['hashtags']]
     except KeyError:
         hashtags = None
+    # Mentions
+    try:
+        mentioned_handles = [m['tag'] for m in tweet['entities']['mentions']]
+        mentioned_author_ids = [handle2author_id[h] for h in mentioned_handles]
+    except KeyError:
+        mentioned_handles = None
+        mentioned_author_ids = None
     # Media
     try:
         media_keys = tweet['attachments']['media_keys']
@@ -377,61 +795,70 @@ def get_tweet_insert(tweet, event, query_type, direct):
     except KeyError:
         source = None
     # Referenced tweets
-    ref_tweets = {'replied_to': None, 'quoted': None, 'retweeted': None}
+    replied_to = None
+    quoted = None
+    retweeted = None
     try:
-        ref_tweets.update({r['type']: r['id'] for r in tweet['referenced_tweets']})
+        for ref_tweet in tweet['referenced_tweets']:
+            if ref_tweet['type'] == 'replied_to':
+                replied_to = ref_tweet['id']
+            elif ref_tweet['type'] == 'quoted':
+                quoted = ref_tweet['id']
+            elif ref_tweet['type'] == 'retweeted':
+                retweeted = ref_tweet['id']
     except KeyError:
         pass
-
+    # Authors of referenced tweets
+    if ref_type2author is None:
+        ref_type2author = dict()
+        ref_type2n_followers = dict()
+    replied_to_author_id,replied_to_handle = ref_type2author.get('replied_to', (None, None))
+    quoted_author_id,quoted_handle = ref_type2author.get('quoted', (None, None))
+    retweeted_author_id,retweeted_handle = ref_type2author.get('retweeted', (None, None))
+
+    author_id = tweet['author_id']
+    metrics = tweet['public_metrics']
     now = datetime.now()
 
-    # Set all tweet insertion data
-    tweet_insert = {
-        'id': tweet['id'],
-        'event': event,
-        'inserted_at': now,
-        'last_updated_at': now,
-        'from_search': False,
-        'directly_from_search': False,
-        'from_stream': False,
-        'directly_from_stream': False,
-        'from_convo_search': False,
-        'directly_from_convo_search': False,
-        'from_quote_search': False,
-        'directly_from_quote_search': False,
-        'from_timeline_search': False,
-        'directly_from_timeline_search': False,
-        'text': tweet['text'].replace('\x00', ''),
-        'lang': tweet['lang'],
-        'author_id': tweet['author_id'],
-        'created_at': parser.parse(tweet['created_at']),
-        'conversation_id': tweet['conversation_id'],
-        'possibly_sensitive': tweet['possibly_sensitive'],
-        'reply_settings': tweet['reply_settings'],
-        'source': source,
-        'retweet_count': tweet['public_metrics']['retweet_count'],
-        'reply_count': tweet['public_metrics']['reply_count'],
-        'like_count': tweet['public_metrics']['like_count'],
-        'quote_count': tweet['public_metrics']['quote_count'],
-        'hashtags': hashtags,
-        'urls': urls,
-        'media_keys': media_keys,
-        'place_id': place_id,
-        'replied_to': ref_tweets['replied_to'],
-        'replied_to_author_id': None,
-        'replied_to_handle': None,
-        'replied_to_follower_count': None,
-        'quoted': ref_tweets['quoted'],
-        'quoted_author_id': None,
-        'quoted_handle': None,
-        'quoted_follower_count': None,
-        'retweeted': ref_tweets['retweeted'],
-        'retweeted_author_id': None,
-        'retweeted_handle': None,
-        'retweeted_follower_count': None
-    }
-    tweet_insert[f"from_{query_type}"] = True
-    tweet_insert[f"directly_from_{query_type}"] = direct
+    tweet_insert = (
+        tweet['id'],
+        event,
+        now,
+        now,
+        *get_source_flags(query_type, direct),
+        tweet['text'].replace('\x00', ''),
+        tweet['lang'],
+        author_id,
+        author_id2handle[author_id],
+        parse_time(tweet['created_at']),
+        tweet['conversation_id'],
+        tweet['possibly_sensitive'],
+        tweet['reply_settings'],
+        source,
+        author_id2n_followers[author_id],
+        metrics['retweet_count'],
+        metrics['reply_count'],
+        metrics['like_count'],
+        metrics['quote_count'],
+        replied_to,
+        replied_to_author_id,
+        replied_to_handle,
+        ref_type2n_followers.get('replied_to'),
+        quoted,
+        quoted_author_id,
+        quoted_handle,
+        ref_type2n_followers.get('quoted'),
+        retweeted,
+        retweeted_author_id,
+        retweeted_handle,
+        ref_type2n_followers.get('retweeted'),
+        mentioned_author_ids,
+        mentioned_handles,
+        hashtags,
+        urls,
+        media_keys,
+        place_id
+    )
 
     return tweet_insert
 
@@ -449,9 +876,9 @@ def get_user_insert(user, event):
 
     Returns
     -------
-    user_insert: dict
-        Dictionary of values extracted and formatted for insertion into a
-        PostgreSQL database
+    user_insert: tuple
+        Values extracted and formatted for insertion into a PostgreSQL
+        database, in the order of `USER_FIELDS`
     """
     # Description hashtags
     try:
@@ -467,7 +894,7 @@ def get_user_insert(user, event):
     # Description URLs
     try:
         urls = user['entities']['description']['urls']
-        urls = [json.dumps(url) for url in urls]
+        urls = [json_dumps(url) for url in urls]
     except KeyError:
         urls = None
     # Profile URL
@@ -476,30 +903,30 @@ def get_user_insert(user, event):
     except (KeyError, IndexError):
         url = None
 
+    metrics = user['public_metrics']
     now = datetime.now()
 
-    user_insert = {
-        'id': user['id'],
-        'event': event,
-        'inserted_at': now,
-        'last_updated_at': now,
-        'created_at': user['created_at'],
-        'followers_count': user['public_metrics']['followers_count'],
-        'following_count': user['public_metrics']['following_count'],
-        'tweet_count': user['public_metrics']['tweet_count'],
-        'url': url,
-        'profile_image_url': user['profile_image_url'],
-        'description_urls': urls,
-        'description_hashtags': hashtags,
-        'description_mentions': mentions,
-        'verified': user['verified']
-    }
-
-    for f in ['description', 'location', 'pinned_tweet_id', 'name', 'username']:
-        try:
-            user_insert[f] = user[f].replace('\x00', '')
-        except KeyError:
-            user_insert[f] = None
+    user_insert = (
+        user['id'],
+        event,
+        now,
+        now,
+        get_clean_str(user, 'name'),
+        get_clean_str(user, 'username'),
+        parse_time(user['created_at']),
+        get_clean_str(user, 'description'),
+        get_clean_str(user, 'location'),
+        get_clean_str(user, 'pinned_tweet_id'),
+        metrics['followers_count'],
+        metrics['following_count'],
+        metrics['tweet_count'],
+        url,
+        user['profile_image_url'],
+        urls,
+        hashtags,
+        mentions,
+        user['verified']
+    )
 
     return user_insert
 
@@ -517,9 +944,9 @@ def get_media_insert(media, event):
 
     Returns
     -------
-    media_insert: dict
-        Dictionary of values extracted and formatted for insertion into a
-        PostgreSQL database
+    media_insert: tuple
+        Values extracted and formatted for insertion into a PostgreSQL
+        database, in the order of `MEDIA_FIELDS`
     """
     # Duration
     try:
@@ -539,18 +966,18 @@ def get_media_insert(media, event):
 
     now = datetime.now()
 
-    media_insert = {
-        'id': media['media_key'],
-        'event': event,
-        'inserted_at': now,
-        'last_updated_at': now,
-        'type': media['type'],
-        'duration_ms': duration_ms,
-        'height': media['height'],
-        'width': media['width'],
-        'preview_image_url': preview_url,
-        'view_count': view_count
-    }
+    media_insert = (
+        media['media_key'],
+        event,
+        now,
+        now,
+        media['type'],
+        duration_ms,
+        media['height'],
+        media['width'],
+        preview_url,
+        view_count
+    )
 
     return media_insert
 
@@ -568,24 +995,154 @@ def get_place_insert(place, event):
 
     Returns
     -------
-    place_insert: dict
-        Dictionary of values extracted and formatted for insertion into a
-        PostgreSQL database
+    place_insert: tuple
+        Values extracted and formatted for insertion into a PostgreSQL
+        database, in the order of `PLACE_FIELDS`
     """
 
     now = datetime.now()
 
-    place_insert = {
-        'id': place['id'],
-        'event': event,
-        'inserted_at': now,
-        'last_updated_at': now,
-        'name': place['name'],
-        'full_name': place['full_name'],
-        'country': place['country'],
-        'country_code': place['country_code'],
-        'geo': Json(place['geo']),
-        'place_type': place['place_type']
-    }
+    place_insert = (
+        place['id'],
+        event,
+        now,
+        now,
+        place['name'],
+        place['full_name'],
+        place['country'],
+        place['country_code'],
+        Json(place['geo']),
+        place['place_type']
+    )
 
     return place_insert
+
+
+# ------------------------------------------------------------------------------
+# --------------------------- Query planning functions -------------------------
+# ------------------------------------------------------------------------------
+def get_equal_slices(counts, n_slices, start_time, end_time):
+    """
+    Splits the time window of a query into slices that each hold roughly the
+    same number of tweets, according to the time series of the counts endpoint.
+    Slices are cut at the boundaries of the count buckets, so a single busy
+    bucket may make the slices uneven or fewer than requested
+
+    Parameters
+    ----------
+    counts: list of dicts
+        Counts of the query in time order, each with the fields `start`, `end`,
+        and `tweet_count`, as returned in the `data` field of the counts
+        endpoint
+    n_slices: int
+        The number of slices to split the window into
+    start_time: str
+        Start time of the query, as YYYY-MM-DDTHH:MM:SSZ
+    end_time: str
+        End time of the query, as YYYY-MM-DDTHH:MM:SSZ
+
+    Returns
+    -------
+    slices: list of tuples
+        The start and end times of each slice, in time order
+    """
+    total_count = sum(count['tweet_count'] for count in counts)
+    if n_slices <= 1 or total_count == 0:
+        return [(start_time, end_time)]
+
+    bounds = [start_time]
+    cum_count = 0
+    slice_n = 1
+    for count in counts:
+        cum_count += count['tweet_count']
+        if slice_n < n_slices and cum_count >= slice_n * total_count / n_slices:
+            bound = parse_time(count['end']).strftime('%Y-%m-%dT%H:%M:%SZ')
+            if bounds[-1] < bound < end_time:
+                bounds.append(bound)
+            while slice_n < n_slices and cum_count >= slice_n * total_count / n_slices:
+                slice_n += 1
+    bounds.append(end_time)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def pack_queries(queries, volumes, max_query_len=1024):
+    """
+    Packs queries into OR queries, balancing their expected volume of tweets.
+    A packed query with v tweets takes ceil(v / page_size) pages, so pages are
+    wasted whenever a packed query's volume spills just past a page. The
+    number of packed queries is set by the maximum query length, and then the
+    queries with the most tweets are placed first, each into the packed query
+    with the least volume so far. This keeps the volumes even, which both
+    minimizes spilled pages and balances the work across concurrent searches
+
+    Parameters
+    ----------
+    queries: list of strs
+        Queries to pack, e.g. "conversation_id:{id}"
+    volumes: list of ints
+        The expected number of tweets of each query. If all are 0, the queries
+        are only packed by length
+    max_query_len: int
+        The maximum length of a packed query. Defaults to 1024, the limit of
+        the full archive search
+
+    Returns
+    -------
+    packed_queries: list of strs
+        Queries joined with " OR "
+    """
+    # Each query takes its length plus 4 for " OR "
+    n_packs = math.ceil(sum(len(q) + 4 for q in queries) / (max_query_len + 4))
+    packs = [[] for _ in range(n_packs)]
+    pack_lens = [-4] * n_packs
+    # Min heap of the packs by their volume
+    open_packs = [(0, pack_n) for pack_n in range(n_packs)]
+    order = sorted(range(len(queries)), key=lambda i: volumes[i], reverse=True)
+    for i in order:
+        query,volume = queries[i],volumes[i]
+        # Close packs that have no room left for the query. Queries are about
+        # the same length, so they would not have room for later ones either
+        while (len(open_packs) > 0
+               and pack_lens[open_packs[0][1]] + 4 + len(query) > max_query_len):
+            heapq.heappop(open_packs)
+        if len(open_packs) > 0:
+            pack_volume,pack_n = heapq.heappop(open_packs)
+        else:
+            packs.append([])
+            pack_lens.append(-4)
+            pack_volume,pack_n = 0,len(packs) - 1
+        packs[pack_n].append(query)
+        pack_lens[pack_n] += 4 + len(query)
+        heapq.heappush(open_packs, (pack_volume + volume, pack_n))
+
+    return [' OR '.join(pack) for pack in packs if len(pack) > 0]
+
+
+def round_time(time, bucket_hours, up=False):
+    """
+    Rounds a time down (or up) to the boundary of its time bucket. Buckets are
+    counted from midnight UTC, January 1st, 1970
+
+    Parameters
+    ----------
+    time: datetime
+        The time to round
+    bucket_hours: float
+        The width of the buckets, in hours. If 0, the time is not rounded
+    up: bool
+        Whether to round up instead of down. Defaults to False
+
+    Returns
+    -------
+    rounded_time: datetime
+        The rounded time
+    """
+    if bucket_hours <= 0:
+        return time
+    bucket_width = timedelta(hours=bucket_hours)
+    epoch = datetime(1970, 1, 1, tzinfo=time.tzinfo)
+    rounded_time = time - (time - epoch) % bucket_width
+    if up and rounded_time < time:
+        rounded_time += bucket_width
+    return rounded_time
@@ -1,11 +1,16 @@
 import sys
 import time
-import json
 import yaml
 import psycopg2
+import threading
 from pprint import pprint
+from operator import itemgetter
 from datetime import datetime
 from .helper import *
+from .codec import json_dumps
+from .archive import ArchiveWriter
+from .ratelimit import RateLimiter
+from .cache import UpdateCache, SeenSet
 
 date_format = '%Y-%m-%dT%H:%M:%SZ'
 
@@ -19,7 +24,8 @@ class APIListener():
                  config_f,
                  append,
                  verbose,
-                 update_interval):
+                 update_interval,
+                 session=None):
         self.event = event
         self.query_type = query_type
 
@@ -41,6 +47,19 @@ class APIListener():
         self.bearer_token = config['keys']['twitter']['bearer_token']
         self.headers = {"Authorization": f"Bearer {self.bearer_token}"}
 
+        # HTTP session shared by all API calls
+        try:
+            http_config = config['http']
+        except KeyError:
+            http_config = dict()
+        if session is None:
+            session = get_session(http_config.get('pool_size', 10))
+        self.session = session
+        self.session.headers.update(self.headers)
+        # No timeouts unless set in the config file
+        self.timeout = (http_config.get('connect_timeout'),
+                        http_config.get('read_timeout'))
+
         # JSON output
         self.out_json_dir = config['output']['json']['twitter'][query_type]
         self.out_json_fname = f"{self.out_json_dir}/{event}.json"
@@ -48,6 +67,12 @@ class APIListener():
             self.write_mode = 'a+'
         else:
             self.write_mode = 'w+'
+        try:
+            self.archive_config = config['archive']
+        except KeyError:
+            self.archive_config = {'compression': None}
+        # Lock for writing to a JSON file shared with other processes
+        self.out_json_lock = None
         # Database output
         schema = config['output']['psql']['twitter']['schema']
         tables = config['output']['psql']['twitter']['tables']
@@ -56,16 +81,23 @@ class APIListener():
         self.tables['users'] = f"{schema}.{tables['users']}"
         self.tables['media'] = f"{schema}.{tables['media']}"
         self.tables['places'] = f"{schema}.{tables['places']}"
+        try:
+            self.write_method = config['output']['psql']['twitter']['write_method']
+        except KeyError:
+            self.write_method = 'insert'
+        if self.write_method not in {'insert', 'copy'}:
+            raise ValueError(f"Unknown write method: {self.write_method}")
 
         # Database connection
-        self.conn = psycopg2.connect(host=config['psql']['host'],
-                                     port=config['psql']['port'],
-                                     user=config['psql']['user'],
-                                     database=config['psql']['database'],
-                                     password=config['psql']['password'])
-        self.conn.autocommit = True
-        self.cur = self.conn.cursor()
-        self.cur.execute("SET TIME ZONE 'UTC';")
+        self.connect_db()
+
+        # Partitions of the event, if the tables are partitioned by event
+        try:
+            partition_by = config['output']['psql']['twitter']['partition_by']
+        except KeyError:
+            partition_by = None
+        if partition_by == 'event':
+            self.create_event_partitions()
 
         # Fields
         request_fields = config['request_fields']['twitter']
@@ -78,25 +110,64 @@ class APIListener():
         self.templates = dict()
         self.insert_cmds = dict()
         self.insert_fields = dict()
+        self.update_cmds = dict()
+        self.row_getters = dict()
         for insert_type in ['tweets', 'users', 'media', 'places']:
             try:
                 update_fields = config['update_fields']['twitter'][insert_type]
             except KeyError:
                 update_fields = None
-            insert_fields = set(config['insert_fields']['twitter'][insert_type].keys())
+            insert_fields = list(config['insert_fields']['twitter'][insert_type].keys())
             self.insert_fields[insert_type] = insert_fields
+            self.row_getters[insert_type] = get_row_getter(insert_fields,
+                                                           INSERT_TYPE2FIELDS[insert_type])
             table = self.tables[insert_type]
 
             update_cmd = get_update_cmd(update_fields, self.query_type, insert_type)
             insert_cmd,template = get_insert_cmd(insert_fields, table, update_cmd)
             self.insert_cmds[insert_type] = insert_cmd
             self.templates[insert_type] = template
+            self.update_cmds[insert_type] = update_cmd
 
             if insert_type == 'tweets':
                 ref_insert_cmd,_ = get_insert_cmd(insert_fields, table)
                 self.templates['ref'] = template
                 self.insert_cmds['ref'] = ref_insert_cmd
                 self.insert_fields['ref'] = insert_fields
+                self.update_cmds['ref'] = None
+                self.row_getters['ref'] = self.row_getters['tweets']
+
+        # Caches of written data, to skip rewriting it across pages
+        self.caches = dict()
+        try:
+            cache_configs = config['caches']
+        except KeyError:
+            cache_configs = dict()
+        for insert_type in ['users', 'media']:
+            if insert_type in cache_configs:
+                update_fields = config['update_fields']['twitter'][insert_type]
+                cache_config = cache_configs[insert_type]
+                self.caches[insert_type] = UpdateCache(update_fields,
+                                                       INSERT_TYPE2FIELDS[insert_type],
+                                                       size=cache_config['size'],
+                                                       max_age_mins=cache_config['max_age_mins'])
+        if 'ref' in cache_configs:
+            self.caches['ref'] = SeenSet(size=cache_configs['ref']['size'])
+
+        # Staging tables for copy writing
+        if self.write_method == 'copy':
+            self.set_stage_tables()
+
+        # Watermarks of the earliest and latest tweet times of the event
+        try:
+            watermark_tables = config['output']['psql']['twitter']['watermark_tables']
+            self.watermark_tables = {
+                'events': f"{schema}.{watermark_tables['events']}",
+                'groups': f"{schema}.{watermark_tables['groups']}"
+            }
+            self.set_watermark_tables()
+        except KeyError:
+            self.watermark_tables = None
 
         # Params of request
         self.params = dict()
@@ -110,6 +181,10 @@ class APIListener():
         self.prev_update_time_mark = now
         self.rate_limit = None
         self.n_calls_last_15mins = None
+        self.rate_limiter = RateLimiter()
+        # Counters are updated by searching and writing threads and reset by
+        # whichever thread checks the rate limit
+        self.counter_lock = threading.Lock()
 
         if self.verbose:
             now = datetime.now().strftime("%Y-%m-%d %I:%M%p")
@@ -129,15 +204,17 @@ class APIListener():
     def check_response_exception(self, response):
         """
         Checks to see if the status code returned by a response is valid. If
-        not, then it raises an exception with a given message
+        not, then it raises an exception with a given message. Also updates the
+        rate limit state from the response's headers
 
         Parameters
         ----------
         response: obj
             A response object from a request made via the requests library
         """
+        self.rate_limiter.update(response)
         if not response.ok:
-            if response.status_code == 503:
+            if response.status_code >= 500:
                 self.temp_unavail = True
                 if self.verbose:
                     print('\nAPI service is temporarily unavailable')
@@ -154,8 +231,9 @@ class APIListener():
     def check_rate_limit(self):
         """
         Checks if the query has exceeded the rate limit or the service is
-        temporarily unavailable. If so, pauses search. Also handles printing
-        out regular updates
+        temporarily unavailable. If so, pauses search until the rate limit
+        window resets, or backs off exponentially if the service is unavailable.
+        Also handles printing out regular updates
         """
         update_reset = False
         unavail_reset = False
@@ -165,42 +243,51 @@ class APIListener():
         now = time.time()
         secs_since_prev_15mins = now - self.prev_15min_time_mark
         secs_since_last_update = now - self.prev_update_time_mark
-        if (self.n_calls_last_15mins >= self.rate_limit) or self.pause:
-            n_sleep_secs = 900 - secs_since_prev_15mins + 15 # add a little extra
+        # The stream's rate limit headers are for connecting, not for tweets
+        exhausted = self.query_type != 'stream' and self.rate_limiter.is_exhausted()
+        if (self.n_calls_last_15mins >= self.rate_limit) or self.pause or exhausted:
+            # Wait until the reset time the API gives if there is one
+            n_sleep_secs = self.rate_limiter.get_reset_secs()
+            if n_sleep_secs is None:
+                n_sleep_secs = 900 - secs_since_prev_15mins + 15 # add a little extra
             if self.verbose:
                 print('Stopping for {} mins'.format(round(n_sleep_secs/60)))
                 print(f"Previous 15 min mark: {self.prev_15min_time_mark}")
                 print(f"Seconds since last 15 min mark: {secs_since_prev_15mins}")
                 print(f"Calls since last 15 min mark: {self.n_calls_last_15mins}")
+                print(f"Rate limit state: {self.rate_limiter.get_state()}")
             time.sleep(n_sleep_secs)
+            now = time.time()
             rate_limit_reset = True
             update_reset = True
         elif 900 - secs_since_prev_15mins < 0:
             rate_limit_reset = True
             update_reset = True
         elif self.temp_unavail:
+            n_sleep_secs = self.rate_limiter.get_backoff_secs()
             if self.verbose:
-                print('Stopping for 30 seconds')
-            time.sleep(30)
+                print(f"Stopping for {round(n_sleep_secs)} seconds")
+            time.sleep(n_sleep_secs)
             unavail_reset = True
         elif secs_since_last_update > self.update_interval_secs:
             update_reset = True
 
         # Reset status to keep listener running, and print update
         if rate_limit_reset or update_reset:
-            if rate_limit_reset:
-                n_tweets = self.n_tweets_last_15mins
-                n_mins = 15
-                self.n_calls_last_15mins = 0
-                self.n_tweets_last_15mins = 0
-                self.prev_15min_time_mark = now
-                self.pause = False
-            if update_reset:
-                if update_reset and not rate_limit_reset:
-                    n_tweets = self.n_tweets_since_update
-                    n_mins = round(secs_since_last_update/60)
-                self.n_tweets_since_update = 0
-                self.prev_update_time_mark = now
+            with self.counter_lock:
+                if rate_limit_reset:
+                    n_tweets = self.n_tweets_last_15mins
+                    n_mins = 15
+                    self.n_calls_last_15mins = 0
+                    self.n_tweets_last_15mins = 0
+                    self.prev_15min_time_mark = now
+                    self.pause = False
+                if update_reset:
+                    if update_reset and not rate_limit_reset:
+                        n_tweets = self.n_tweets_since_update
+                        n_mins = round(secs_since_last_update/60)
+                    self.n_tweets_since_update = 0
+                    self.prev_update_time_mark = now
             if self.verbose:
                 self.print_update(n_tweets, n_mins)
         if unavail_reset:
@@ -213,7 +300,18 @@ class APIListener():
         interval and how many calls have been made
 
         Time to sleep = # secs remaining / # calls remaining to be made
+
+        If the API has reported its rate limit in the response headers, then the
+        time and calls remaining in its window are used instead
         """
+        n_sleep_secs = self.rate_limiter.get_pace_secs()
+        if n_sleep_secs is not None:
+            if self.query_type != 'stream':
+                # Full archive search has minimum 1 request / sec limit too
+                n_sleep_secs = max(1, n_sleep_secs)
+            time.sleep(n_sleep_secs)
+            return
+
         now = time.time()
         secs_since_prev_15mins = now - self.prev_15min_time_mark
         n_secs_remaining = 900 - secs_since_prev_15mins
@@ -228,6 +326,195 @@ class APIListener():
             self.pause = True
 
 
+    def connect_db(self):
+        """
+        Connects to the PostgreSQL database set in the `psql` fields of the
+        config file
+        """
+        psql_config = self.config['psql']
+        self.conn = psycopg2.connect(host=psql_config['host'],
+                                     port=psql_config['port'],
+                                     user=psql_config['user'],
+                                     database=psql_config['database'],
+                                     password=psql_config['password'])
+        self.conn.autocommit = True
+        self.cur = self.conn.cursor()
+        self.cur.execute("SET TIME ZONE 'UTC';")
+
+
+    def create_event_partitions(self):
+        """
+        Creates the event's partition of each table, if it does not already
+        exist. Rows of events without a partition go to the default partition
+        """
+        for table in self.tables.values():
+            try:
+                self.cur.execute(get_partition_cmd(table, self.event),
+                                 {'event': self.event})
+            except (psycopg2.errors.DuplicateTable, psycopg2.errors.UniqueViolation):
+                # Created at the same time by another listener of the event,
+                # which can also collide on the partition's row type
+                pass
+
+
+    def open_out_json(self, out_json_fname=None):
+        """
+        Opens the output for raw JSON tweets. This is either a single JSON file,
+        or a compressed archive of rotating segments if compression is set in
+        the `archive` fields of the config file
+
+        Parameters
+        ----------
+        out_json_fname: str
+            The JSON output filename. Defaults to the event's filename
+
+        Returns
+        -------
+        out_json_f: file or ArchiveWriter
+            The output to write raw JSON tweets to
+        """
+        if out_json_fname is None:
+            out_json_fname = self.out_json_fname
+        compression = self.archive_config.get('compression')
+        if compression is None:
+            return open(out_json_fname, self.write_mode)
+        else:
+            return ArchiveWriter(out_json_fname, self.write_mode, compression,
+                                 segment_mb=self.archive_config.get('segment_mb', 1024),
+                                 segment_mins=self.archive_config.get('segment_mins', 1440))
+
+
+    def set_stage_tables(self):
+        """
+        Creates temporary staging tables for copy writing, and the commands for
+        merging them into the event tables. There is one staging table per
+        insert type, so tweets and referenced tweets are staged separately
+        """
+        self.stage_tables = dict()
+        self.merge_cmds = dict()
+        for insert_type in ['tweets', 'ref', 'users', 'media', 'places']:
+            if insert_type == 'ref':
+                table = self.tables['tweets']
+            else:
+                table = self.tables[insert_type]
+            stage_table = f"stage_{insert_type}"
+            self.cur.execute(get_stage_cmd(table, stage_table))
+            self.stage_tables[insert_type] = stage_table
+
+            insert_fields = self.insert_fields[insert_type]
+            update_cmd = self.update_cmds[insert_type]
+            merge_cmd = get_merge_cmd(insert_fields, table, stage_table, update_cmd)
+            self.merge_cmds[insert_type] = merge_cmd
+
+
+    def set_watermark_tables(self):
+        """
+        Creates the watermark tables, if they do not already exist. For each
+        event and source of direct tweets (e.g. "search" or "stream"), they
+        record the earliest and latest tweet times, overall and per
+        conversation and author, so that searches can look up an event's time
+        bounds without scanning the tweets table. The watermarks are updated
+        on every write (see `update_watermarks`). An event's watermarks for a
+        source are `complete` once they have been built from all the tweets
+        written before watermarks were kept (see `SearchListener`). The tweet
+        and reply counts of conversations and authors are only recounted from
+        the tweets table when a search needs them, for groups that are `stale`
+        """
+        event_cmd = f"""
+        CREATE TABLE IF NOT EXISTS {self.watermark_tables['events']} (
+            event TEXT,
+            source TEXT,
+            min_time TIMESTAMPTZ,
+            max_time TIMESTAMPTZ,
+            complete BOOLEAN,
+            last_updated_at TIMESTAMPTZ,
+            PRIMARY KEY (event, source)
+        );
+        """
+        group_cmd = f"""
+        CREATE TABLE IF NOT EXISTS {self.watermark_tables['groups']} (
+            event TEXT,
+            source TEXT,
+            group_type TEXT,
+            group_id TEXT,
+            min_time TIMESTAMPTZ,
+            max_time TIMESTAMPTZ,
+            n_tweets BIGINT,
+            n_replies BIGINT,
+            stale BOOLEAN,
+            PRIMARY KEY (event, source, group_type, group_id)
+        );
+        """
+        self.cur.execute(event_cmd)
+        self.cur.execute(group_cmd)
+
+        insert_fields = self.insert_fields['tweets']
+        self.watermark_getter = itemgetter(insert_fields.index('created_at'),
+                                           insert_fields.index('conversation_id'),
+                                           insert_fields.index('author_id'))
+
+
+    def update_watermarks(self, tweet_rows):
+        """
+        Widens the event's watermarks to cover a set of written direct tweets.
+        Searches write some tweets again (e.g. when updating), so the tweet and
+        reply counts of conversations and authors are not added to here, and
+        their groups are marked as stale instead
+
+        Parameters
+        ----------
+        tweet_rows: list of tuples
+            Rows of direct tweets, as returned by `get_all_inserts`
+        """
+        if len(tweet_rows) == 0:
+            return
+        group2watermark = dict()
+        created_ats = []
+        for row in tweet_rows:
+            created_at,conversation_id,author_id = self.watermark_getter(row)
+            created_ats.append(created_at)
+            for group in [('conversation_id', conversation_id), ('author_id', author_id)]:
+                if group[1] is None:
+                    continue
+                elif group in group2watermark:
+                    min_time,max_time = group2watermark[group]
+                    group2watermark[group] = (min(min_time, created_at),
+                                              max(max_time, created_at))
+                else:
+                    group2watermark[group] = (created_at, created_at)
+
+        event_table = self.watermark_tables['events']
+        event_cmd = f"""
+        INSERT INTO {event_table}
+        (event, source, min_time, max_time, complete, last_updated_at)
+        VALUES (%s, %s, %s, %s, FALSE, NOW())
+        ON CONFLICT (event, source) DO UPDATE SET
+            min_time = LEAST({event_table}.min_time, EXCLUDED.min_time),
+            max_time = GREATEST({event_table}.max_time, EXCLUDED.max_time),
+            last_updated_at = EXCLUDED.last_updated_at
+        """
+        self.cur.execute(event_cmd, (self.event, self.query_type,
+                                     min(created_ats), max(created_ats)))
+
+        group_table = self.watermark_tables['groups']
+        group_cmd = f"""
+        INSERT INTO {group_table}
+        (event, source, group_type, group_id, min_time, max_time, stale)
+        VALUES %s
+        ON CONFLICT (event, source, group_type, group_id) DO UPDATE SET
+            min_time = LEAST({group_table}.min_time, EXCLUDED.min_time),
+            max_time = GREATEST({group_table}.max_time, EXCLUDED.max_time),
+            stale = TRUE
+        WHERE {group_table}.stale IS NOT TRUE
+            OR EXCLUDED.min_time < {group_table}.min_time
+            OR EXCLUDED.max_time > {group_table}.max_time
+        """
+        # Sorted so that concurrent writers lock rows in the same order
+        group_rows = [(self.event, self.query_type, group_type, group_id) + watermark + (True,)
+                      for (group_type,group_id),watermark in sorted(group2watermark.items())]
+        psycopg2.extras.execute_values(self.cur, group_cmd, group_rows)
+
+
     def manage_writing(self, response_json):
         """
         Coordinates the writing of data, namely handling exceptions and updating
@@ -239,16 +526,17 @@ class APIListener():
             JSON from an API response produced via the response library
         """
         try:
-            if self.query_type == 'stream':
-                tweets = [response_json['data']]
-            else:
-                tweets = response_json['data']
+            tweets = response_json['data']
+            if isinstance(tweets, dict):
+                # Stream messages hold a single tweet rather than a list
+                tweets = [tweets]
             includes = response_json['includes']
             self.write(tweets, includes)
 
-            self.n_tweets_total += len(tweets)
-            self.n_tweets_since_update += len(tweets)
-            self.n_tweets_last_15mins += len(tweets)
+            with self.counter_lock:
+                self.n_tweets_total += len(tweets)
+                self.n_tweets_since_update += len(tweets)
+                self.n_tweets_last_15mins += len(tweets)
         except KeyError as err:
             if 'meta' in response_json and 'result_count' in response_json['meta']:
                 if response_json['meta']['result_count'] == 0:
@@ -273,20 +561,60 @@ class APIListener():
         -----------
         tweets: list of dicts
             List of dictionary tweet objects. The return of the `data` field
-            from the API. Note: for the stream, we manually wrap it in a list
-            because only a single tweet is returned
+            from the API. Note: for the stream, a single tweet is returned per
+            message, so it is wrapped in a list or batched with other messages
+            via `merge_responses`
         includes: dict of dicts
             Dictionary of different referenced objects that were included. The
             return of the `includes` field from the API
         """
-        all_inserts = get_all_inserts(tweets, includes, self.event, self.query_type)
+        all_inserts = get_all_inserts(tweets, includes, self.event, self.query_type,
+                                      self.row_getters, self.caches)
 
         # Write to database
+        if self.write_method == 'copy':
+            self.copy_inserts(all_inserts)
+        else:
+            self.insert_values(all_inserts)
+        if self.watermark_tables is not None:
+            self.update_watermarks(all_inserts[0])
+
+        # Write to JSON
+        out_strs = [json_dumps(tweet) for tweet in tweets]
+        if isinstance(self.out_json_f, ArchiveWriter):
+            self.out_json_f.write_tweets(tweets, out_strs)
+        else:
+            out_str = ''.join(f"{s}\n" for s in out_strs)
+            if self.out_json_lock is None:
+                self.out_json_f.write(out_str)
+            else:
+                # The file is shared with writers in other processes, so each
+                # block is written and flushed whole
+                with self.out_json_lock:
+                    self.out_json_f.write(out_str)
+                    self.out_json_f.flush()
+
+
+    def insert_values(self, all_inserts):
+        """
+        Inserts data into the database with one `INSERT` statement per insert
+        type
+
+        Parameters
+        ----------
+        all_inserts: tuple of lists of tuples
+            Rows of tweet, referenced tweet, user, media, and place insertion
+            data, as returned by `get_all_inserts`
+        """
         insert_types = ['tweets', 'ref', 'users', 'media', 'places']
         for insert_type,inserts in zip(insert_types, all_inserts):
             # Insert
             template = self.templates[insert_type]
             insert_cmd = self.insert_cmds[insert_type]
+            # Lock rows in a consistent order so concurrent writers can't
+            # deadlock on each other's upserts
+            id_index = self.insert_fields[insert_type].index('id')
+            inserts = sorted(inserts, key=itemgetter(id_index))
 
             try:
                 psycopg2.extras.execute_values(self.cur,
@@ -303,10 +631,45 @@ class APIListener():
                 print()
                 raise e
 
-        # Write to JSON
-        for tweet in tweets:
-            out_str = json.dumps(tweet)
-            self.out_json_f.write(f"{out_str}\n")
+
+    def copy_inserts(self, all_inserts):
+        """
+        Inserts data into the database by copying it into the staging tables
+        and merging each staging table into its event table. All insert types
+        are written in a single transaction, and the update semantics are the
+        same as when using `insert_values`
+
+        Parameters
+        ----------
+        all_inserts: tuple of lists of tuples
+            Rows of tweet, referenced tweet, user, media, and place insertion
+            data, as returned by `get_all_inserts`
+        """
+        insert_types = ['tweets', 'ref', 'users', 'media', 'places']
+        self.cur.execute("BEGIN;")
+        for insert_type,inserts in zip(insert_types, all_inserts):
+            if len(inserts) == 0:
+                continue
+            stage_table = self.stage_tables[insert_type]
+            insert_fields = self.insert_fields[insert_type]
+            merge_cmd = self.merge_cmds[insert_type]
+            fields_str = ','.join(insert_fields)
+            copy_cmd = f"COPY {stage_table} ({fields_str}) FROM STDIN"
+
+            try:
+                self.cur.execute(f"TRUNCATE {stage_table};")
+                copy_buffer = get_copy_buffer(inserts)
+                self.cur.copy_expert(copy_cmd, copy_buffer)
+                self.cur.execute(merge_cmd)
+            except Exception as e:
+                self.cur.execute("ROLLBACK;")
+                print(f"Failed copy: {insert_type}\n")
+                pprint(inserts)
+                print()
+                print(f"Merge command\n{merge_cmd}\n")
+                print()
+                raise e
+        self.cur.execute("COMMIT;")
 
 
     def print_update(self, n_tweets, n_mins):
@@ -0,0 +1,263 @@
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+
+
+class TokenBucket():
+    """
+    Thread-safe token bucket for sharing a single API rate limit across several
+    concurrent requesters. Each call takes one token from the bucket, and tokens
+    are refilled continuously. The refill rate is set so that no more than
+    `n_calls` are ever made in any window of `window_secs` seconds, even when
+    the bucket starts full
+
+    Parameters
+    ----------
+    n_calls: int
+        The number of calls allowed per rate limit window
+    window_secs: float
+        The length of the rate limit window, in seconds. Defaults to 900 (15
+        minutes)
+    min_interval_secs: float
+        The minimum number of seconds between any two calls. Defaults to 1, the
+        per second limit of the full archive search
+    burst: int
+        The number of tokens the bucket can hold, i.e. how many calls can be
+        made back to back (subject to `min_interval_secs`). Must be less than
+        `n_calls`, so that tokens are refilled. Defaults to 1
+    """
+    def __init__(self,
+                 n_calls,
+                 window_secs=900,
+                 min_interval_secs=1,
+                 burst=1):
+        if burst >= n_calls:
+            raise ValueError(f"Burst of {burst} must be less than the {n_calls} calls per window")
+        self.n_calls = n_calls
+        self.window_secs = window_secs
+        self.min_interval_secs = min_interval_secs
+        self.burst = burst
+        self.refill_rate = (n_calls - burst) / window_secs
+
+        self.tokens = burst
+        self.prev_refill_time = time.time()
+        self.prev_call_time = 0
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+
+    def refill(self, now):
+        """
+        Adds the tokens accrued since the last refill, up to the bucket size
+
+        Parameters
+        ----------
+        now: float
+            The current time, in seconds since the epoch
+        """
+        n_secs = now - self.prev_refill_time
+        self.tokens = min(self.burst, self.tokens + n_secs * self.refill_rate)
+        self.prev_refill_time = now
+
+
+    def acquire(self):
+        """
+        Blocks until a call can be made without going over the rate limit, and
+        then takes a token for that call
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.refill(now)
+                if self.tokens >= 1:
+                    n_refill_secs = 0
+                else:
+                    n_refill_secs = (1 - self.tokens) / self.refill_rate
+                n_wait_secs = max(self.paused_until - now,
+                                  self.prev_call_time + self.min_interval_secs - now,
+                                  n_refill_secs)
+                if n_wait_secs <= 0:
+                    self.tokens -= 1
+                    self.prev_call_time = now
+                    return
+            time.sleep(n_wait_secs)
+
+
+    def pause(self, n_secs):
+        """
+        Stops all calls from being made for a number of seconds, e.g. after the
+        API says that the rate limit has been exceeded
+
+        Parameters
+        ----------
+        n_secs: float
+            How many seconds to wait before allowing calls again
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + n_secs)
+            self.tokens = 0
+
+
+class RateLimiter():
+    """
+    Tracks the rate limit of an endpoint using the headers of the API's
+    responses. The API reports how many calls are remaining in the current
+    window (`x-rate-limit-remaining`) and when the window resets
+    (`x-rate-limit-reset`), so the listener can wait exactly until the reset
+    rather than estimating it from its own call counts. Server errors are
+    retried with exponential backoff and jitter
+
+    Parameters
+    ----------
+    base_backoff_secs: float
+        How many seconds to wait after the first server error. Each consecutive
+        error doubles the wait. Defaults to 5
+    max_backoff_secs: float
+        The longest that a single backoff can wait, in seconds. Defaults to 320
+    reset_buffer_secs: float
+        Extra seconds to wait past the reset time, to allow for clock
+        differences with the API. Defaults to 1
+    """
+    def __init__(self,
+                 base_backoff_secs=5,
+                 max_backoff_secs=320,
+                 reset_buffer_secs=1):
+        self.base_backoff_secs = base_backoff_secs
+        self.max_backoff_secs = max_backoff_secs
+        self.reset_buffer_secs = reset_buffer_secs
+
+        self.limit = None
+        self.remaining = None
+        self.reset_time = None
+        self.retry_after_time = None
+        self.n_errors = 0
+        self.lock = threading.Lock()
+
+
+    def update(self, response):
+        """
+        Updates the rate limit state from the status and headers of a response
+
+        Parameters
+        ----------
+        response: obj
+            A response object from a request made via the requests library
+        """
+        headers = response.headers
+        with self.lock:
+            try:
+                self.limit = int(headers['x-rate-limit-limit'])
+                self.remaining = int(headers['x-rate-limit-remaining'])
+                self.reset_time = int(headers['x-rate-limit-reset'])
+            except (KeyError, ValueError):
+                pass
+
+            if 'retry-after' in headers:
+                self.retry_after_time = parse_retry_after(headers['retry-after'])
+            if response.status_code >= 500:
+                self.n_errors += 1
+            elif response.ok:
+                self.n_errors = 0
+                self.retry_after_time = None
+
+
+    def is_exhausted(self):
+        """
+        Returns whether the API has said that no calls are remaining in the
+        current window
+        """
+        with self.lock:
+            return (self.remaining is not None and self.remaining <= 0
+                    and self.reset_time is not None
+                    and self.reset_time > time.time())
+
+
+    def get_reset_secs(self):
+        """
+        Returns the number of seconds to wait until calls can be made again
+        after going over the rate limit, or None if the API has not said when
+        the window resets
+        """
+        with self.lock:
+            reset_times = [t for t in [self.reset_time, self.retry_after_time]
+                           if t is not None]
+            if len(reset_times) == 0:
+                return None
+            n_secs = max(reset_times) - time.time() + self.reset_buffer_secs
+            return max(0, n_secs)
+
+
+    def get_pace_secs(self):
+        """
+        Returns the number of seconds to wait between calls to spread the
+        remaining calls evenly over the rest of the window, or None if the API
+        has not reported its rate limit
+        """
+        with self.lock:
+            if self.remaining is None or self.reset_time is None:
+                return None
+            n_secs_remaining = self.reset_time - time.time()
+            if n_secs_remaining <= 0:
+                return 0
+            return n_secs_remaining / max(1, self.remaining)
+
+
+    def get_backoff_secs(self):
+        """
+        Returns the number of seconds to wait after a server error. The wait
+        doubles with each consecutive error, and a random half of it is jitter
+        so that concurrent requesters do not retry all at once
+        """
+        with self.lock:
+            n_exp = max(0, self.n_errors - 1)
+            cap = min(self.max_backoff_secs, self.base_backoff_secs * 2**n_exp)
+            if self.retry_after_time is not None:
+                cap = max(cap, self.retry_after_time - time.time())
+        return cap / 2 + random.uniform(0, cap / 2)
+
+
+    def get_state(self):
+        """
+        Returns the current rate limit state
+
+        Returns
+        -------
+        state: dict
+            Dictionary of the call limit, number of calls remaining, and reset
+            time of the current window (None if not reported by the API), and
+            the number of consecutive server errors
+        """
+        with self.lock:
+            state = {'limit': self.limit,
+                     'remaining': self.remaining,
+                     'reset_time': self.reset_time,
+                     'retry_after_time': self.retry_after_time,
+                     'n_errors': self.n_errors}
+        return state
+
+
+def parse_retry_after(retry_after):
+    """
+    Parses the value of a `Retry-After` header, which is either a number of
+    seconds or an HTTP date
+
+    Parameters
+    ----------
+    retry_after: str
+        Value of the header
+
+    Returns
+    -------
+    retry_after_time: float
+        The time at which to retry, in seconds since the epoch, or None if the
+        value could not be parsed
+    """
+    try:
+        return time.time() + float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return parsedate_to_datetime(retry_after).timestamp()
+    except (TypeError, ValueError):
+        return None
@@ -1,16 +1,22 @@
-import json
+import time
 import yaml
+import types
+import queue
 import signal
 import argparse
-import requests
 import warnings
+import psycopg2
+import threading
 from queue import Queue
 from pprint import pprint
 from datetime import datetime
+from datetime import timezone
 from datetime import timedelta
 from dateutil import parser as dateparser
 from .helper import *
+from .codec import json_dumps, json_loads
 from .listener import APIListener
+from .ratelimit import TokenBucket
 
 date_format = '%Y-%m-%dT%H:%M:%SZ'
 
@@ -153,6 +159,51 @@ class SearchListener(APIListener):
         Whether to print out information/updates of the search. Defaults to True
     update_interval: int
         How often to print updates of the number of tweets collected, in minutes
+    n_workers: int
+        How many queries to search concurrently. All queries share the same
+        rate limit, and each paginates through its own results. Defaults to 1,
+        which searches the queries one after another. Counting is always done
+        one query at a time
+    resume: bool
+        Whether to resume the last search of this event and query type from
+        where it stopped. The queries and the progress through them are saved
+        to a checkpoint table as the search runs, so resuming skips queries that
+        were finished and continues the query that was in progress from its
+        last written page. If there is nothing to resume, runs a new search
+    pipeline_depth: int
+        How many pages of search results can wait to be written while the next
+        pages are requested. Defaults to 0, which writes each page before
+        requesting the next one. Only used when searching one query at a time
+    session: requests.Session
+        HTTP session to make API calls with. Defaults to a new pooled session
+        configured by the `http` fields of the config file
+    n_slices: int
+        How many time slices to split each query of a generic search into. The
+        counts endpoint is used to cut the query's time window into slices with
+        roughly the same number of tweets, and each slice is searched and
+        checkpointed as its own query, so slices can be searched concurrently
+        (see `n_workers`) and resumed independently. Defaults to 1, which does
+        not split queries
+    bucket_hours: float
+        When updating or backfilling conversations, quotes, or timelines, the
+        width of the time buckets that IDs are grouped into, in hours. Each ID's
+        start time (if updating) or end time (if backfilling) is rounded to its
+        bucket, and the IDs of each bucket are packed into OR queries. Wider
+        buckets mean fewer queries but more tweets fetched again. Defaults to
+        24. If 0, only IDs with exactly the same times are packed together
+    queries: list of strs
+        Queries to search in place of those in the event's query file, e.g. the
+        rules of a stream when backfilling a gap in it. These searches are not
+        checkpointed, so they do not replace the checkpoints of the event's own
+        search and cannot be resumed. Only used for generic searches
+    id_batch_size: int
+        When getting conversations, quotes, or timelines from the database,
+        how many IDs to read at a time, in order of their IDs. IDs are packed
+        into queries as they are read, so the search starts after the first
+        batch and memory does not grow with the number of IDs. These searches
+        are not checkpointed, since not all of their queries are known up
+        front. Defaults to 0, which reads all IDs before searching. Not used
+        when counting or when IDs are read from an input file
     """
     def __init__(self,
                  event,
@@ -176,7 +227,15 @@ class SearchListener(APIListener):
                  append=True,
                  write_count_files=None,
                  verbose=True,
-                 update_interval=15):
+                 update_interval=15,
+                 n_workers=1,
+                 resume=False,
+                 pipeline_depth=0,
+                 session=None,
+                 n_slices=1,
+                 bucket_hours=24,
+                 queries=None,
+                 id_batch_size=0):
         if get_convos:
             query_type = 'convo_search'
         elif get_quotes:
@@ -191,7 +250,8 @@ class SearchListener(APIListener):
                          config_f=config_f,
                          append=append,
                          verbose=verbose,
-                         update_interval=update_interval)
+                         update_interval=update_interval,
+                         session=session)
         self.update = update
         self.backfill = backfill
         self.get_counts = get_counts
@@ -204,12 +264,27 @@ class SearchListener(APIListener):
         self.end_time = end_time
         self.n_days_back = n_days_back
         self.n_days_after = n_days_after
+        self.n_workers = n_workers
+        self.resume = resume
+        self.pipeline_depth = pipeline_depth
+        self.input_queries = queries
+        self.n_slices = n_slices
+        self.bucket_hours = bucket_hours
+        # Count files are numbered by the total number of queries
+        if get_counts:
+            self.id_batch_size = 0
+        else:
+            self.id_batch_size = id_batch_size
+        self.query_iter = None
+        self.query_lock = threading.Lock()
 
         self.unavail_user = False
         self.n_calls_last_15mins = 0
         self.rate_limit = self.config['rate_limits']['twitter']['search']
+        self.token_bucket = TokenBucket(self.rate_limit)
+        self.count_endpoint = self.config['endpoints']['twitter']['count']
         if get_counts:
-            self.search_endpoint = self.config['endpoints']['twitter']['count']
+            self.search_endpoint = self.count_endpoint
         else:
             self.search_endpoint = self.config['endpoints']['twitter']['search']
 
@@ -219,6 +294,7 @@ class SearchListener(APIListener):
             self.total_query_tweet_count = 0
 
         # Set defaults if convo or timeline search
+        self.ids_input_f = None
         if get_convos:
             self.query_type = 'convo_search'
             self.set_convo_defaults(convo_ids_f)
@@ -228,8 +304,9 @@ class SearchListener(APIListener):
         elif get_timelines:
             self.query_type = 'timeline_search'
             self.set_timeline_defaults(user_ids_f)
-        if convo_ids_f is None and user_ids_f is None:
-            self.ids_input_f = None
+        # IDs from an input file are all read up front
+        if self.ids_input_f is not None:
+            self.id_batch_size = 0
         if not (get_convos or get_quotes or get_timelines):
             self.query_breadth = 'directly_from_search OR directly_from_stream'
             self.retweet_breadth = ''
@@ -256,25 +333,48 @@ class SearchListener(APIListener):
         # Open here and not general listening class in case final name changed
         # Count file gets opened in `update_query` since it dynamically changes
         if not get_counts:
-            self.out_json_f = open(self.out_json_fname, self.write_mode)
+            self.out_json_f = self.open_out_json()
+
+        # Checkpoints of search progress
+        schema = self.config['output']['psql']['twitter']['schema']
+        try:
+            checkpoint_table = self.config['output']['psql']['twitter']['checkpoint_table']
+        except KeyError:
+            checkpoint_table = 'search_checkpoints'
+        self.checkpoint_table = f"{schema}.{checkpoint_table}"
+        self.resume_tokens = dict()
+        resumed = False
+        self.checkpointing = not get_counts and queries is None
+        if self.id_batch_size > 0 and (get_convos or get_quotes or get_timelines):
+            self.checkpointing = False
+            if resume:
+                warnings.warn("Searches that read IDs in batches cannot be resumed")
+        if self.checkpointing:
+            self.set_checkpoint_table()
+            if resume:
+                resumed = self.load_checkpoints()
 
         # Set up queries and query parameters
-        self.get_earliest_latest_event_times()
-        if get_timelines or get_convos or get_quotes:
-            self.get_query_ids()
+        if not resumed:
+            self.get_earliest_latest_event_times()
+            if get_timelines or get_convos or get_quotes:
+                self.get_query_ids()
 
-        self.set_start_time()
-        self.set_end_time()
+            self.set_start_time()
+            self.set_end_time()
 
-        if not (get_convos or get_timelines or get_quotes):
-            self.set_search_queries()
-        else:
-            self.set_alt_search_queries()
+            if not (get_convos or get_timelines or get_quotes):
+                self.set_search_queries()
+            else:
+                self.set_alt_search_queries()
 
-        if self.verbose:
-            print('Search params: ')
-            print(f"\tStart time: {self.params['start_time']}")
-            print(f"\tEnd time: {self.params['end_time']}\n")
+            if self.checkpointing:
+                self.save_checkpoints()
+
+            if self.verbose:
+                print('Search params: ')
+                print(f"\tStart time: {self.params['start_time']}")
+                print(f"\tEnd time: {self.params['end_time']}\n")
 
         if get_counts:
             self.params['granularity'] = granularity
@@ -298,6 +398,9 @@ class SearchListener(APIListener):
         """
         self.group_by_id = 'conversation_id'
         self.query_operator = 'conversation_id'
+        # Expected number of tweets per conversation, for packing queries
+        self.volume_expr = 'SUM(COALESCE(reply_count, 0))'
+        self.watermark_volume = 'n_replies'
         self.query_breadth = 'directly_from_search OR directly_from_stream'
         self.retweet_breadth = ''
         if self.start_time is None:
@@ -314,6 +417,8 @@ class SearchListener(APIListener):
         """
         self.group_by_id = 'id,author_handle'
         self.query_operator = 'url'
+        # Expected number of quotes per tweet, for packing queries
+        self.volume_expr = 'MAX(COALESCE(quote_count, 0))'
         if not self.get_quotes_of_quotes:
             self.query_breadth = 'directly_from_search'
         else:
@@ -337,6 +442,10 @@ class SearchListener(APIListener):
         """
         self.group_by_id = 'author_id'
         self.query_operator = 'from'
+        # Expected number of tweets per timeline, for packing queries. Users
+        # that are more active in the event are usually more active overall
+        self.volume_expr = 'COUNT(*)'
+        self.watermark_volume = 'n_tweets'
         self.query_breadth = 'directly_from_search OR directly_from_stream'
         self.retweet_breadth = ''
         if self.start_time is None:
@@ -353,13 +462,19 @@ class SearchListener(APIListener):
         If doing an update, backfill, conversation search OR a timeline or
         conversation search with an input file OR otherwise assuming that this
         event has been searched/streamed before, gets the earliest and latest
-        times of tweets from the event
+        times of tweets from the event. These are read from the watermark
+        tables if they are set in the config file, except for quote searches
         """
         if (self.update or self.backfill or self.get_convos or self.get_quotes
             or ((self.get_timelines or self.get_convos) and self.ids_input_f is None)
             or self.start_time in {'first_time', 'last_time'}
             or self.end_time in {'first_time', 'last_time'}):
 
+            if self.watermark_tables is not None and not self.get_quotes:
+                # Same breadth as the query breadth below
+                self.first_time,self.last_time = self.get_event_watermarks(['search', 'stream'])
+                return
+
             tweet_table = self.tables['tweets']
             minmax_cmd = f"""
             SELECT
@@ -379,33 +494,53 @@ class SearchListener(APIListener):
         """
         If doing a conversation or timeline search, either gets the conversation
         or user IDs from a prior search or stream of the event, or loads them
-        from the input file
+        from the input file. IDs from a prior search or stream come with their
+        earliest and latest tweet times and their expected volume of tweets,
+        read from the watermark tables if they are set in the config file,
+        except for quote searches. If `id_batch_size` is set, IDs from the
+        database are read lazily in batches (see `iter_query_ids`)
         """
         if self.ids_input_f is None:
-            tweet_table = self.tables['tweets']
-            breadth = f"{self.query_breadth} {self.retweet_breadth}"
-            if self.get_convos or self.get_timelines:
-                # tweets from directly_from_* will  extend the time boundary for
-                # convos/user IDs, helping avoid duplicates if backfill/update had
-                # to be stopped and restarted midway through
-                # In this implementation, can't avoid duplicates for quotes because
-                # the time bounds depend on what *quoted* tweets have been retrieved
-                # while the search itself is still based on the original tweets
-                breadth += f" OR directly_from_{self.query_type}"
-            group_cmd = f"""
-            SELECT
-                {self.group_by_id},
-                MIN(created_at) as min_time,
-                MAX(created_at) as max_time
-            FROM
-                {tweet_table}
-            WHERE
-                event = %(event)s
-                AND ({breadth})
-            GROUP BY
-                {self.group_by_id}
-            """
-            self.cur.execute(group_cmd, {'event': self.event})
+            if self.watermark_tables is not None and not self.get_quotes:
+                # Same breadth as the grouping below
+                sources = ['search', 'stream', self.query_type]
+                group_cmd,group_params = self.get_group_watermark_cmd(self.group_by_id,
+                                                                      sources)
+                key_fields = 'group_id'
+            else:
+                tweet_table = self.tables['tweets']
+                breadth = f"{self.query_breadth} {self.retweet_breadth}"
+                if self.get_convos or self.get_timelines:
+                    # tweets from directly_from_* will  extend the time boundary for
+                    # convos/user IDs, helping avoid duplicates if backfill/update had
+                    # to be stopped and restarted midway through
+                    # In this implementation, can't avoid duplicates for quotes because
+                    # the time bounds depend on what *quoted* tweets have been retrieved
+                    # while the search itself is still based on the original tweets
+                    breadth += f" OR directly_from_{self.query_type}"
+                group_cmd = f"""
+                SELECT
+                    {self.group_by_id},
+                    MIN(created_at) as min_time,
+                    MAX(created_at) as max_time,
+                    {self.volume_expr} as volume
+                FROM
+                    {tweet_table}
+                WHERE
+                    event = %(event)s
+                    AND ({breadth})
+                GROUP BY
+                    {self.group_by_id}
+                """
+                group_params = {'event': self.event}
+                key_fields = self.group_by_id
+
+            if self.id_batch_size > 0:
+                self.query_ids = self.iter_query_ids(group_cmd, group_params, key_fields)
+                if self.verbose:
+                    print(f"Reading IDs in batches of {self.id_batch_size:,}")
+                return
+            self.cur.execute(group_cmd, group_params)
             self.query_ids = self.cur.fetchall()
             if self.verbose:
                 if self.get_convos:
@@ -418,7 +553,7 @@ class SearchListener(APIListener):
             self.query_ids = []
             with open(self.ids_input_f, 'r') as f_in:
                 for line in f_in:
-                    self.query_ids.append((line.strip(), None, None))
+                    self.query_ids.append((line.strip(), None, None, None))
             if self.verbose:
                 if self.get_timelines:
                     print(f"{len(self.query_ids):,} timelines to retrieve")
@@ -426,6 +561,251 @@ class SearchListener(APIListener):
                     print(f"{len(self.query_ids):,} conversations to retrieve")
 
 
+    def iter_query_ids(self, query_cmd, query_params, key_fields):
+        """
+        Reads the rows of a query of IDs in batches of `id_batch_size` rows,
+        ordered by their IDs. Each batch is its own query that starts after the
+        last ID of the previous batch, so the search can begin after the first
+        batch arrives and no transaction stays open during the search to hold
+        back vacuuming or block schema changes. Rows without an ID are skipped.
+        The rows are read on their own autocommitting connection so that they
+        do not compete with writing
+
+        Parameters
+        ----------
+        query_cmd: str
+            Command that selects the IDs with their times and volumes
+        query_params: dict
+            Parameters of the command
+        key_fields: str
+            Comma-separated fields of the command that identify each row, and
+            that the rows are ordered by
+
+        Yields
+        ------
+        query_info: tuple
+            Row of an ID, as from `get_query_ids`
+        """
+        key_fields = [field.strip() for field in key_fields.split(',')]
+        key_str = ', '.join(key_fields)
+        last_key_str = ', '.join(f"%(last_key_{n})s" for n in range(len(key_fields)))
+        first_batch_cmd = f"""
+        SELECT * FROM ({query_cmd}) AS query_ids
+        WHERE ({key_str}) IS NOT NULL
+        ORDER BY {key_str}
+        LIMIT %(batch_size)s
+        """
+        batch_cmd = f"""
+        SELECT * FROM ({query_cmd}) AS query_ids
+        WHERE ({key_str}) > ({last_key_str})
+        ORDER BY {key_str}
+        LIMIT %(batch_size)s
+        """
+        batch_params = dict(query_params)
+        batch_params['batch_size'] = self.id_batch_size
+
+        psql_config = self.config['psql']
+        conn = psycopg2.connect(host=psql_config['host'],
+                                port=psql_config['port'],
+                                user=psql_config['user'],
+                                database=psql_config['database'],
+                                password=psql_config['password'])
+        conn.autocommit = True
+        try:
+            cur = conn.cursor()
+            cur.execute("SET TIME ZONE 'UTC';")
+            cur.execute(first_batch_cmd, batch_params)
+            while True:
+                rows = cur.fetchall()
+                for query_info in rows:
+                    yield query_info
+                if len(rows) < self.id_batch_size:
+                    break
+                for n,key in enumerate(rows[-1][:len(key_fields)]):
+                    batch_params[f"last_key_{n}"] = key
+                cur.execute(batch_cmd, batch_params)
+            cur.close()
+        finally:
+            conn.close()
+
+
+    def build_watermarks(self, sources):
+        """
+        Builds the watermarks of the event for any sources whose watermarks are
+        not complete, by scanning the tweets table once. After that, the
+        watermarks are kept up to date as tweets are written
+
+        Parameters
+        ----------
+        sources: list of strs
+            Sources of direct tweets, e.g. "search" or "stream"
+        """
+        event_table = self.watermark_tables['events']
+        group_table = self.watermark_tables['groups']
+        tweet_table = self.tables['tweets']
+        complete_cmd = f"""
+        SELECT source FROM {event_table}
+        WHERE event = %(event)s AND source = ANY(%(sources)s) AND complete
+        """
+        self.cur.execute(complete_cmd, {'event': self.event, 'sources': sources})
+        complete_sources = {row[0] for row in self.cur.fetchall()}
+
+        for source in sources:
+            if source in complete_sources:
+                continue
+            if self.verbose:
+                print(f"Building watermarks of {source} tweets")
+            self.cur.execute("BEGIN;")
+            try:
+                for group_type in ['conversation_id', 'author_id']:
+                    group_cmd = f"""
+                    INSERT INTO {group_table}
+                    (event, source, group_type, group_id, min_time, max_time,
+                     n_tweets, n_replies, stale)
+                    SELECT
+                        event, %(source)s, %(group_type)s, {group_type},
+                        MIN(created_at), MAX(created_at), COUNT(*),
+                        SUM(COALESCE(reply_count, 0)), FALSE
+                    FROM {tweet_table}
+                    WHERE event = %(event)s AND directly_from_{source}
+                        AND {group_type} IS NOT NULL
+                    GROUP BY event, {group_type}
+                    ON CONFLICT (event, source, group_type, group_id) DO UPDATE SET
+                        min_time = LEAST({group_table}.min_time, EXCLUDED.min_time),
+                        max_time = GREATEST({group_table}.max_time, EXCLUDED.max_time),
+                        n_tweets = EXCLUDED.n_tweets,
+                        n_replies = EXCLUDED.n_replies,
+                        stale = FALSE
+                    """
+                    self.cur.execute(group_cmd, {'event': self.event,
+                                                 'source': source,
+                                                 'group_type': group_type})
+                event_cmd = f"""
+                INSERT INTO {event_table}
+                (event, source, min_time, max_time, complete, last_updated_at)
+                SELECT %(event)s, %(source)s, MIN(created_at), MAX(created_at), TRUE, NOW()
+                FROM {tweet_table}
+                WHERE event = %(event)s AND directly_from_{source}
+                ON CONFLICT (event, source) DO UPDATE SET
+                    min_time = LEAST({event_table}.min_time, EXCLUDED.min_time),
+                    max_time = GREATEST({event_table}.max_time, EXCLUDED.max_time),
+                    complete = TRUE,
+                    last_updated_at = EXCLUDED.last_updated_at
+                """
+                self.cur.execute(event_cmd, {'event': self.event, 'source': source})
+            except Exception as e:
+                self.cur.execute("ROLLBACK;")
+                raise e
+            self.cur.execute("COMMIT;")
+
+
+    def recount_stale_groups(self, group_type, sources):
+        """
+        Recounts the tweets and replies of the event's conversations or authors
+        whose watermarks changed since they were last counted. Counts are not
+        kept up to date on write because searches write some tweets again
+
+        Parameters
+        ----------
+        group_type: str
+            Either "conversation_id" or "author_id"
+        sources: list of strs
+            Sources of direct tweets, e.g. "search" or "stream"
+        """
+        group_table = self.watermark_tables['groups']
+        tweet_table = self.tables['tweets']
+        for source in sources:
+            recount_cmd = f"""
+            UPDATE {group_table} AS w SET
+                n_tweets = c.n_tweets,
+                n_replies = c.n_replies,
+                stale = FALSE
+            FROM (
+                SELECT
+                    {group_type} AS group_id,
+                    COUNT(*) AS n_tweets,
+                    SUM(COALESCE(reply_count, 0)) AS n_replies
+                FROM {tweet_table}
+                WHERE event = %(event)s AND directly_from_{source}
+                    AND {group_type} IN (
+                        SELECT group_id FROM {group_table}
+                        WHERE event = %(event)s AND source = %(source)s
+                            AND group_type = %(group_type)s AND stale
+                    )
+                GROUP BY {group_type}
+            ) AS c
+            WHERE w.event = %(event)s AND w.source = %(source)s
+                AND w.group_type = %(group_type)s AND w.group_id = c.group_id
+            """
+            self.cur.execute(recount_cmd, {'event': self.event,
+                                           'source': source,
+                                           'group_type': group_type})
+
+
+    def get_event_watermarks(self, sources):
+        """
+        Gets the earliest and latest times of the event's direct tweets from a
+        set of sources
+
+        Parameters
+        ----------
+        sources: list of strs
+            Sources of direct tweets, e.g. "search" or "stream"
+
+        Returns
+        -------
+        min_time, max_time: datetimes
+            The earliest and latest tweet times, or None if there are no tweets
+        """
+        self.build_watermarks(sources)
+        watermark_cmd = f"""
+        SELECT MIN(min_time), MAX(max_time)
+        FROM {self.watermark_tables['events']}
+        WHERE event = %(event)s AND source = ANY(%(sources)s)
+        """
+        self.cur.execute(watermark_cmd, {'event': self.event, 'sources': sources})
+        return self.cur.fetchone()
+
+
+    def get_group_watermark_cmd(self, group_type, sources):
+        """
+        Creates the command for getting the earliest and latest times and the
+        expected volume of tweets of each conversation or author in the event's
+        direct tweets from a set of sources, building their watermarks and
+        recounting stale groups if needed. Volumes are approximate: a tweet can
+        come directly from more than one source, so the largest count of any
+        one source is used, which is a lower bound on the group's volume
+
+        Parameters
+        ----------
+        group_type: str
+            Either "conversation_id" or "author_id"
+        sources: list of strs
+            Sources of direct tweets, e.g. "search" or "stream"
+
+        Returns
+        -------
+        watermark_cmd: str
+            Command that selects the ID, earliest time, latest time, and
+            expected volume of each conversation or author
+        watermark_params: dict
+            Parameters of the command
+        """
+        self.build_watermarks(sources)
+        self.recount_stale_groups(group_type, sources)
+        watermark_cmd = f"""
+        SELECT group_id, MIN(min_time), MAX(max_time), MAX({self.watermark_volume})
+        FROM {self.watermark_tables['groups']}
+        WHERE event = %(event)s AND group_type = %(group_type)s
+            AND source = ANY(%(sources)s)
+        GROUP BY group_id
+        """
+        watermark_params = {'event': self.event,
+                            'group_type': group_type,
+                            'sources': sources}
+        return watermark_cmd,watermark_params
+
+
     def set_start_time(self):
         """
         Sets the start time to use for the search based on the user input
@@ -479,13 +859,16 @@ class SearchListener(APIListener):
     def set_search_queries(self):
         """
         If doing a generic search (not conversations or timelines), reads the
-        queries from the event file, and does final processing of the start
-        and end time of the queries
+        queries from the event file, unless queries were given, and does final
+        processing of the start and end time of the queries
         """
         self.queries = Queue()
-        self.query_f = f"{self.config['input']['twitter']['search']}/{self.event}.yaml"
-        with open(self.query_f) as fin:
-            search_queries = yaml.load(fin, Loader=yaml.Loader)
+        if self.input_queries is not None:
+            search_queries = {'queries': self.input_queries}
+        else:
+            self.query_f = f"{self.config['input']['twitter']['search']}/{self.event}.yaml"
+            with open(self.query_f) as fin:
+                search_queries = yaml.load(fin, Loader=yaml.Loader)
 
         # Set start and end time if not already set
         if 'start_time' in search_queries and self.params['start_time'] is None:
@@ -499,51 +882,349 @@ class SearchListener(APIListener):
             end_datetime += timedelta(self.n_days_after)
             self.params['end_time'] = end_datetime.strftime(date_format)
 
-        # Add queries
+        # Add queries, split into time slices if set
+        q_start_time = self.params['start_time']
+        q_end_time = self.params['end_time']
+        split = self.n_slices > 1 and not self.get_counts
+        if split and (q_start_time is None or q_end_time is None):
+            warnings.warn("WARNING: queries can only be sliced with a start and end time")
+            split = False
         for q in search_queries['queries']:
-            self.queries.put((q, self.params['start_time'], self.params['end_time']))
+            if split:
+                counts = self.get_count_series(q, q_start_time, q_end_time)
+                slices = get_equal_slices(counts, self.n_slices, q_start_time, q_end_time)
+                for slice_start_time,slice_end_time in slices:
+                    self.queries.put((q, slice_start_time, slice_end_time))
+            else:
+                self.queries.put((q, q_start_time, q_end_time))
+        if split and self.verbose:
+            n_queries = len(search_queries['queries'])
+            print(f"Split {n_queries:,} queries into {self.queries.qsize():,} time slices")
+
+
+    def get_count_series(self, query, start_time, end_time, granularity='hour'):
+        """
+        Gets the time series of how many tweets a query matches from the counts
+        endpoint
+
+        Parameters
+        ----------
+        query: str
+            The query to count
+        start_time: str
+            Start time of the count
+        end_time: str
+            End time of the count
+        granularity: str
+            The granularity of the time series, either `"minute"`, `"hour"`, or
+            `"day"`. Defaults to `"hour"`
+
+        Returns
+        -------
+        counts: list of dicts
+            Counts in time order, each with the fields `start`, `end`, and
+            `tweet_count`
+        """
+        params = {'query': query,
+                  'start_time': start_time,
+                  'end_time': end_time,
+                  'granularity': granularity}
+        counts = []
+        while True:
+            self.check_rate_limit()
+            response = self.session.get(self.count_endpoint, params=params,
+                                        timeout=self.timeout)
+            self.n_calls_last_15mins += 1
+            self.check_response_exception(response)
+            if self.pause or self.temp_unavail:
+                continue
+
+            response_json = json_loads(response.content)
+            if 'data' in response_json:
+                counts.extend(response_json['data'])
+            # Paced after the last page too, since queries are counted back
+            # to back
+            self.limit_rate()
+            if 'next_token' in response_json['meta']:
+                params['next_token'] = response_json['meta']['next_token']
+            else:
+                break
+
+        counts.sort(key=lambda count: count['start'])
+        return counts
 
 
     def set_alt_search_queries(self):
         """
         If doing a conversation, quote, or timeline search, formats the IDs into
-        queries to the send to the API
+        queries to the send to the API (see `iter_alt_search_queries`). If IDs
+        are read in batches, the queries are made lazily as the search asks for
+        them, and otherwise they are all put on the queue
         """
-        cur_query = []
-        cur_query_len = 0
         self.queries = Queue()
+        query_iter = self.iter_alt_search_queries(self.params['start_time'],
+                                                  self.params['end_time'])
+        if self.id_batch_size > 0:
+            self.query_iter = query_iter
+        else:
+            for query_info in query_iter:
+                self.queries.put(query_info)
+
+
+    def iter_alt_search_queries(self, start_time, end_time):
+        """
+        Packs the IDs into OR queries that balance their expected volume of
+        tweets (see `pack_queries`), so that fewer pages are requested. If
+        updating or backfilling, each ID has its own time window, so IDs are
+        first grouped into time buckets (see `bucket_hours`) that share a
+        window, and then packed within each bucket. If IDs are read in batches,
+        every bucket is packed once `id_batch_size` IDs are waiting across all
+        of them, and whatever is left is packed after the last ID
+
+        Parameters
+        ----------
+        start_time: str
+            Start time of the search, used for IDs without their own window
+        end_time: str
+            End time of the search, used for IDs without their own window
+
+        Yields
+        ------
+        query_info: tuple
+            A packed query and its start and end times
+        """
+        bucket2queries = dict()
+        n_ids = 0
+        n_waiting_ids = 0
+        n_packed_queries = 0
         for query_info in self.query_ids:
             if not self.get_quotes:
-                q_id,min_time,max_time = query_info
+                q_id,min_time,max_time,volume = query_info
                 query = f"{self.query_operator}:{q_id}"
             else:
-                q_id,q_handle,min_time,max_time = query_info
+                q_id,q_handle,min_time,max_time,volume = query_info
                 query = f'url:"https://twitter.com/{q_handle}/status/{q_id}"'
-            query_len = len(query)
-            if self.backfill:
-                q_start_time = self.params['start_time']
+            q_start_time = start_time
+            q_end_time = end_time
+            if self.backfill and min_time is not None:
+                # Overfetch up to the end of the bucket, as long as it's over
+                now = datetime.now(timezone.utc).replace(tzinfo=min_time.tzinfo)
+                bucket_end_time = round_time(min_time, self.bucket_hours, up=True)
+                if bucket_end_time < now - timedelta(minutes=1):
+                    min_time = bucket_end_time
                 q_end_time = min_time.strftime(date_format)
-                self.queries.put((query, q_start_time, q_end_time))
-            elif self.update:
+            elif self.update and max_time is not None:
+                # Overfetch from the start of the bucket
+                max_time = round_time(max_time, self.bucket_hours)
                 q_start_time = max_time.strftime(date_format)
-                q_end_time = self.params['end_time']
-                self.queries.put((query, q_start_time, q_end_time))
-
-            # len of all queries + " OR " + new query + " OR " for new query
-            elif cur_query_len + 4*(len(cur_query) - 1) + query_len + 4 > 1024:
-                self.queries.put((' OR '.join(cur_query),
-                                  self.params['start_time'],
-                                  self.params['end_time']))
-                cur_query = [query]
-                cur_query_len = query_len
-            else:
-                cur_query.append(query)
-                cur_query_len += query_len
 
-        # Put final query
-        if not (self.update or self.backfill):
-            self.queries.put((' OR '.join(cur_query), self.params['start_time'],
-                              self.params['end_time']))
+            bucket = (q_start_time, q_end_time)
+            if bucket not in bucket2queries:
+                bucket2queries[bucket] = ([], [])
+            bucket2queries[bucket][0].append(query)
+            bucket2queries[bucket][1].append(volume or 0)
+            n_ids += 1
+            n_waiting_ids += 1
+
+            if self.id_batch_size > 0 and n_waiting_ids >= self.id_batch_size:
+                for (q_start_time,q_end_time),(queries,volumes) in bucket2queries.items():
+                    for packed_query in pack_queries(queries, volumes):
+                        yield (packed_query, q_start_time, q_end_time)
+                        n_packed_queries += 1
+                bucket2queries = dict()
+                n_waiting_ids = 0
+
+        for (q_start_time,q_end_time),(queries,volumes) in bucket2queries.items():
+            for packed_query in pack_queries(queries, volumes):
+                yield (packed_query, q_start_time, q_end_time)
+                n_packed_queries += 1
+        if self.verbose:
+            print(f"Packed {n_ids:,} IDs into {n_packed_queries:,} queries")
+
+
+    def get_next_query(self):
+        """
+        Gets the next query to search, first from the queue and then, if IDs
+        are read in batches, from the lazily made queries. Safe to call from
+        several search workers at once
+
+        Returns
+        -------
+        query_info: tuple
+            The query and its start and end times, or None if there are no
+            more queries
+        """
+        try:
+            return self.queries.get(block=False)
+        except queue.Empty:
+            pass
+        if self.query_iter is None:
+            return None
+        with self.query_lock:
+            return next(self.query_iter, None)
+
+
+    def close_query_iter(self):
+        """
+        Stops making queries lazily, which closes the connection that IDs are
+        read on
+        """
+        if self.query_iter is not None:
+            with self.query_lock:
+                self.query_iter.close()
+                if isinstance(self.query_ids, types.GeneratorType):
+                    self.query_ids.close()
+
+
+    def set_checkpoint_table(self):
+        """
+        Creates the table that records the progress of searches, if it does not
+        already exist. Each row is a query of an event's search, with the next
+        token of its last written page and whether all its pages were written
+        """
+        checkpoint_cmd = f"""
+        CREATE TABLE IF NOT EXISTS {self.checkpoint_table} (
+            event TEXT,
+            query_type TEXT,
+            query TEXT,
+            start_time TEXT,
+            end_time TEXT,
+            query_order INTEGER,
+            next_token TEXT,
+            completed BOOLEAN,
+            last_updated_at TIMESTAMPTZ,
+            PRIMARY KEY (event, query_type, query, start_time, end_time)
+        )
+        """
+        self.cur.execute(checkpoint_cmd)
+
+
+    def save_checkpoints(self):
+        """
+        Records all the queries of a new search in the checkpoint table,
+        replacing the checkpoints of any previous search of the same event and
+        query type. Times that are not set are stored as empty strings because
+        they are part of the key
+        """
+        query_infos = []
+        while self.queries.qsize() > 0:
+            query_infos.append(self.queries.get(block=False))
+        for query_info in query_infos:
+            self.queries.put(query_info)
+
+        delete_cmd = f"""
+        DELETE FROM {self.checkpoint_table}
+        WHERE event = %(event)s AND query_type = %(query_type)s
+        """
+        self.cur.execute(delete_cmd, {'event': self.event,
+                                      'query_type': self.query_type})
+        now = datetime.now()
+        checkpoints = [(self.event, self.query_type, q, q_start or '', q_end or '',
+                        n, None, False, now)
+                       for n,(q,q_start,q_end) in enumerate(query_infos)]
+        insert_cmd = f"""
+        INSERT INTO {self.checkpoint_table}
+        (event, query_type, query, start_time, end_time, query_order,
+         next_token, completed, last_updated_at)
+        VALUES %s ON CONFLICT DO NOTHING
+        """
+        psycopg2.extras.execute_values(self.cur, insert_cmd, checkpoints)
+
+
+    def load_checkpoints(self):
+        """
+        Loads the queries that are left from the last search of the event and
+        query type, along with the next token of any query that was in progress
+
+        Returns
+        -------
+        resumed: bool
+            Whether there were checkpoints to resume from
+        """
+        select_cmd = f"""
+        SELECT query, start_time, end_time, next_token, completed
+        FROM {self.checkpoint_table}
+        WHERE event = %(event)s AND query_type = %(query_type)s
+        ORDER BY query_order
+        """
+        self.cur.execute(select_cmd, {'event': self.event,
+                                      'query_type': self.query_type})
+        checkpoints = self.cur.fetchall()
+        if len(checkpoints) == 0:
+            if self.verbose:
+                print('No checkpoints to resume from, starting a new search')
+            return False
+
+        self.queries = Queue()
+        n_completed = 0
+        for q,q_start,q_end,next_token,completed in checkpoints:
+            if completed:
+                n_completed += 1
+                continue
+            query_info = (q, q_start or None, q_end or None)
+            self.queries.put(query_info)
+            if next_token is not None:
+                self.resume_tokens[query_info] = next_token
+        self.params['start_time'] = None
+        self.params['end_time'] = None
+
+        if self.verbose:
+            print(f"Resuming search: {n_completed:,} of {len(checkpoints):,} queries finished")
+        return True
+
+
+    def update_checkpoint(self, query_info, next_token):
+        """
+        Records the progress of a query after one of its pages was written
+
+        Parameters
+        ----------
+        query_info: tuple
+            The query and its start and end times
+        next_token: str
+            The next token of the written page, or None if it was the last page
+            of the query
+        """
+        if not self.checkpointing:
+            return
+        q,q_start,q_end = query_info
+        update_cmd = f"""
+        UPDATE {self.checkpoint_table}
+        SET next_token = %(next_token)s,
+            completed = %(completed)s,
+            last_updated_at = %(now)s
+        WHERE event = %(event)s AND query_type = %(query_type)s
+            AND query = %(query)s AND start_time = %(start_time)s
+            AND end_time = %(end_time)s
+        """
+        self.cur.execute(update_cmd, {'next_token': next_token,
+                                      'completed': next_token is None,
+                                      'now': datetime.now(),
+                                      'event': self.event,
+                                      'query_type': self.query_type,
+                                      'query': q,
+                                      'start_time': q_start or '',
+                                      'end_time': q_end or ''})
+
+
+    def write_page(self, response_json, query_info):
+        """
+        Writes a page of search results and then records that the page's query
+        has progressed up to it. The raw JSON is flushed before the checkpoint,
+        so that a resumed search never skips pages that are not on disk
+
+        Parameters
+        ----------
+        response_json: dict
+            JSON from an API response produced via the response library
+        query_info: tuple
+            The query and its start and end times
+        """
+        self.manage_writing(response_json)
+        if self.checkpointing:
+            self.out_json_f.flush()
+        next_token = response_json['meta'].get('next_token')
+        self.update_checkpoint(query_info, next_token)
 
 
     def update_query(self):
@@ -560,13 +1241,16 @@ class SearchListener(APIListener):
             self.query_number += 1
             pad_num = str(self.query_number).zfill(self.n_zeros)
             self.out_json_fname = f"{self.out_json_dir}/{self.event}_counts_{pad_num}.json"
-        if self.queries.qsize() > 0:
-            q,q_start,q_end = self.queries.get(block=False)
+        query_info = self.get_next_query()
+        if query_info is not None:
+            q,q_start,q_end = query_info
             self.params['query'] = q
             self.params['start_time'] = q_start
             self.params['end_time'] = q_end
             if 'next_token' in self.params:
                 del self.params['next_token']
+            if (q, q_start, q_end) in self.resume_tokens:
+                self.params['next_token'] = self.resume_tokens.pop((q, q_start, q_end))
             if self.query_type == 'search' and self.verbose:
                 print('\n\tUpdated query')
                 print(f"\t{self.params['query']}")
@@ -582,33 +1266,235 @@ class SearchListener(APIListener):
     def search(self):
         """
         Connects to the Twitter full search archive and writes out the returned
-        data
+        data. If pipelining, pages are written by a separate writing thread so
+        that the next page can be requested while the current one is written
         """
         signal.signal(signal.SIGINT, self.exit_handler)
+        if self.pipeline_depth > 0:
+            self.start_page_writer()
 
         # Get tweets from search
-        while not self.stop:
-            self.check_rate_limit()
+        try:
+            while not self.stop:
+                self.check_rate_limit()
+
+                response = self.session.get(self.search_endpoint, params=self.params,
+                                            timeout=self.timeout)
+                self.n_calls_last_15mins += 1
+                self.check_response_exception(response)
+                if self.pause or self.temp_unavail:
+                    continue
+
+                # Parse tweets
+                response_json = json_loads(response.content)
+                query_info = (self.params['query'], self.params['start_time'],
+                              self.params['end_time'])
+                if self.pipeline_depth > 0:
+                    self.put_page(response_json, query_info)
+                else:
+                    self.write_page(response_json, query_info)
+                if self.stop:
+                    return
 
-            response = requests.get(self.search_endpoint, headers=self.headers,
-                                    params=self.params)
-            self.n_calls_last_15mins += 1
-            self.check_response_exception(response)
-            if self.pause or self.temp_unavail:
+                if 'next_token' in response_json['meta']:
+                    self.params['next_token'] = response_json['meta']['next_token']
+                else:
+                    self.update_query()
+
+                self.limit_rate()
+        finally:
+            if self.pipeline_depth > 0:
+                self.stop_page_writer()
+            self.close_query_iter()
+
+
+    def start_page_writer(self):
+        """
+        Starts the thread that writes pages of search results as they are put on
+        the page queue. The queue holds at most `pipeline_depth` pages, so the
+        search waits for the writing to catch up if it falls behind
+        """
+        self.page_queue = Queue(maxsize=self.pipeline_depth)
+        self.page_writer_error = None
+        self.page_writer = threading.Thread(target=self.manage_page_queue,
+                                            daemon=True)
+        self.page_writer.start()
+
+
+    def manage_page_queue(self):
+        """
+        Takes pages of search results off of the page queue and writes them,
+        until it receives None
+        """
+        while True:
+            page = self.page_queue.get()
+            if page is None:
+                return
+            try:
+                self.write_page(*page)
+            except Exception as err:
+                self.page_writer_error = err
+                self.stop = True
+                return
+
+
+    def put_page(self, response_json, query_info):
+        """
+        Puts a page of search results on the page queue to be written, waiting
+        if the queue is full
+
+        Parameters
+        ----------
+        response_json: dict
+            JSON from an API response produced via the response library
+        query_info: tuple
+            The query and its start and end times
+        """
+        while True:
+            if self.page_writer_error is not None:
+                raise self.page_writer_error
+            try:
+                self.page_queue.put((response_json, query_info), timeout=1)
+                return
+            except queue.Full:
                 continue
 
-            # Parse tweets
-            response_json = response.json()
-            self.manage_writing(response_json)
+
+    def stop_page_writer(self):
+        """
+        Waits for the writing thread to finish writing the pages left on the
+        page queue, and then stops it
+        """
+        if self.page_writer.is_alive():
+            self.page_queue.put(None)
+            self.page_writer.join()
+        if self.page_writer_error is not None:
+            raise self.page_writer_error
+
+
+    def search_concurrent(self):
+        """
+        Connects to the Twitter full search archive and runs several queries at
+        once, writing out the returned data. Each worker thread takes a query
+        off of the queue and paginates through it until there are no more
+        results, while all workers share the rate limit through a token bucket.
+        Writing is done by one worker at a time
+        """
+        signal.signal(signal.SIGINT, self.exit_handler)
+
+        # The first query was already taken off the queue when initializing
+        if 'query' in self.params:
+            queries = Queue()
+            query_info = (self.params['query'], self.params['start_time'],
+                          self.params['end_time'])
+            queries.put(query_info)
+            if 'next_token' in self.params:
+                self.resume_tokens[query_info] = self.params['next_token']
+            while self.queries.qsize() > 0:
+                queries.put(self.queries.get(block=False))
+            self.queries = queries
+
+        self.write_lock = threading.Lock()
+        self.worker_error = None
+        workers = [threading.Thread(target=self.search_worker, daemon=True)
+                   for _ in range(self.n_workers)]
+        for worker in workers:
+            worker.start()
+
+        # Main thread only handles updates so that it can catch CTRL+C
+        while any(worker.is_alive() for worker in workers):
+            time.sleep(1)
+            now = time.time()
+            secs_since_last_update = now - self.prev_update_time_mark
+            if secs_since_last_update > self.update_interval_secs:
+                with self.counter_lock:
+                    n_tweets = self.n_tweets_since_update
+                    self.n_tweets_since_update = 0
+                self.prev_update_time_mark = now
+                if self.verbose:
+                    self.print_update(n_tweets, round(secs_since_last_update/60))
+
+        self.close_query_iter()
+        if self.worker_error is not None:
+            raise self.worker_error
+        if self.verbose and not self.stop:
+            print('\nNo more queries to run')
+
+
+    def search_worker(self):
+        """
+        Takes queries off of the queue and searches them until there are no
+        more queries or the search is stopped
+        """
+        try:
+            while not self.stop:
+                query_info = self.get_next_query()
+                if query_info is None:
+                    return
+                q,q_start,q_end = query_info
+                params = {k:v for k,v in self.params.items() if k != 'next_token'}
+                params['query'] = q
+                params['start_time'] = q_start
+                params['end_time'] = q_end
+                if (q, q_start, q_end) in self.resume_tokens:
+                    params['next_token'] = self.resume_tokens.pop((q, q_start, q_end))
+                if self.query_type == 'search' and self.verbose:
+                    print('\n\tUpdated query')
+                    print(f"\t{params['query']}")
+                self.search_query(params)
+        except Exception as err:
+            self.worker_error = err
+            self.stop = True
+
+
+    def search_query(self, params):
+        """
+        Paginates through all the results of a single query, writing out the
+        returned data
+
+        Parameters
+        ----------
+        params: dict
+            Parameters of the request, including the query and its start and end
+            times. The next token is tracked here as pages are returned
+        """
+        query_info = (params['query'], params['start_time'], params['end_time'])
+        while not self.stop:
+            self.token_bucket.acquire()
             if self.stop:
                 return
 
+            response = self.session.get(self.search_endpoint, params=params,
+                                        timeout=self.timeout)
+            with self.counter_lock:
+                self.n_calls_last_15mins += 1
+            self.rate_limiter.update(response)
+            if response.status_code == 429:
+                if self.verbose:
+                    print('\nAPI says you are over the rate limit')
+                n_pause_secs = self.rate_limiter.get_reset_secs()
+                if n_pause_secs is None:
+                    n_pause_secs = 900
+                self.token_bucket.pause(n_pause_secs)
+                continue
+            elif response.status_code >= 500:
+                if self.verbose:
+                    print('\nAPI service is temporarily unavailable')
+                time.sleep(self.rate_limiter.get_backoff_secs())
+                continue
+            elif self.rate_limiter.is_exhausted():
+                self.token_bucket.pause(self.rate_limiter.get_reset_secs())
+            self.check_response_exception(response)
+
+            # Parse tweets
+            response_json = json_loads(response.content)
+            with self.write_lock:
+                self.write_page(response_json, query_info)
+
             if 'next_token' in response_json['meta']:
-                self.params['next_token'] = response_json['meta']['next_token']
+                params['next_token'] = response_json['meta']['next_token']
             else:
-                self.update_query()
-
-            self.limit_rate()
+                return
 
 
     def count(self):
@@ -622,15 +1508,15 @@ class SearchListener(APIListener):
         while not self.stop:
             self.check_rate_limit()
 
-            response = requests.get(self.search_endpoint, headers=self.headers,
-                                    params=self.params)
+            response = self.session.get(self.search_endpoint, params=self.params,
+                                        timeout=self.timeout)
             self.n_calls_last_15mins += 1
             self.check_response_exception(response)
             if self.pause or self.temp_unavail:
                 continue
 
             # Parse counts
-            response_json = response.json()
+            response_json = json_loads(response.content)
             self.manage_counting(response_json)
 
             if self.stop:
@@ -664,7 +1550,7 @@ class SearchListener(APIListener):
             if self.write_count_files:
                 counts = response_json['data']
                 for count in counts:
-                    out_str = json.dumps(count)
+                    out_str = json_dumps(count)
                     self.out_json_f.write(f"{out_str}\n")
         except KeyError as err:
             if 'meta' in response_json and 'result_count' in response_json['meta']:
@@ -685,7 +1571,8 @@ def main(event, config_f, max_results_per_page, get_counts, granularity,
          get_convos, get_quotes, get_quotes_of_quotes, get_timelines,
          full_timelines, user_ids_f, convo_ids_f, update, backfill, start_time,
          end_time, n_days_back, n_days_after, append, write_count_files,
-         verbose, update_interval):
+         verbose, update_interval, n_workers, resume, pipeline_depth, n_slices,
+         bucket_hours, id_batch_size):
     """
     Connects to the Twitter API v2 search endpoint
 
@@ -713,10 +1600,18 @@ def main(event, config_f, max_results_per_page, get_counts, granularity,
                            append=append,
                            write_count_files=write_count_files,
                            verbose=verbose,
-                           update_interval=update_interval)
+                           update_interval=update_interval,
+                           n_workers=n_workers,
+                           resume=resume,
+                           pipeline_depth=pipeline_depth,
+                           n_slices=n_slices,
+                           bucket_hours=bucket_hours,
+                           id_batch_size=id_batch_size)
 
     if get_counts:
         search.count()
+    elif n_workers > 1:
+        search.search_concurrent()
     else:
         search.search()
 
@@ -752,6 +1647,11 @@ if __name__ == '__main__':
     parser.add_argument("-n_days_after", type=int, default=0)
     parser.add_argument("-update_interval", type=int, default=15)
     parser.add_argument("-granularity", type=str, default="hour")
+    parser.add_argument("-n_workers", type=int, default=1)
+    parser.add_argument("-pipeline_depth", type=int, default=0)
+    parser.add_argument("-n_slices", type=int, default=1)
+    parser.add_argument("-bucket_hours", type=float, default=24)
+    parser.add_argument("-id_batch_size", type=int, default=0)
     # Booleans can't be parsed directly, so you set a flag for each option
     parser.add_argument("--get_counts", dest="get_counts", action="store_true")
     parser.add_argument("--get_convos", dest="get_convos", action="store_true")
@@ -761,6 +1661,7 @@ if __name__ == '__main__':
     parser.add_argument("--full_timelines", dest="full_timelines", action="store_true")
     parser.add_argument("--update", dest="update", action="store_true")
     parser.add_argument("--backfill", dest="backfill", action="store_true")
+    parser.add_argument("--resume", dest="resume", action="store_true")
     parser.add_argument("--append", dest="append", action="store_true")
     parser.add_argument("--verbose", dest="verbose", action="store_true")
     parser.add_argument("--quiet", dest="verbose", action="store_false")
@@ -770,7 +1671,8 @@ if __name__ == '__main__':
     parser.set_defaults(get_counts=False, get_convos=False, get_quotes=False,
                         get_timelines=False, get_quotes_of_quotes=False,
                         append=True, verbose=True, full_timelines=False,
-                        update=False, backfill=False, write_count_files=None)
+                        update=False, backfill=False, write_count_files=None,
+                        resume=False)
 
     args = parser.parse_args()
 
@@ -795,4 +1697,10 @@ if __name__ == '__main__':
          args.append,
          args.write_count_files,
          args.verbose,
-         args.update_interval)
+         args.update_interval,
+         args.n_workers,
+         args.resume,
+         args.pipeline_depth,
+         args.n_slices,
+         args.bucket_hours,
+         args.id_batch_size)
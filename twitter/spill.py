@@ -0,0 +1,161 @@
+import os
+import glob
+import threading
+
+
+class SpillBuffer():
+    """
+    Overflow for a bounded writing queue. When the queue is full, messages are
+    appended to segment files on disk instead of waiting, and a background
+    thread replays the segments onto the queue, oldest first, as the writers
+    catch up. Segments are only deleted once they have been replayed, so any
+    left behind by a crash are replayed the next time the buffer is opened
+
+    Segments are named `{name}_{number}.spill` and hold one message per line
+
+    Parameters
+    ----------
+    spill_dir: str
+        Directory to write segments to
+    name: str
+        Name of the buffer, e.g. the event name
+    put: function
+        Function that puts a message on the queue, waiting while it is full
+    segment_mb: float
+        Size in megabytes after which a new segment is started. Defaults to 64
+    """
+    def __init__(self,
+                 spill_dir,
+                 name,
+                 put,
+                 segment_mb=64):
+        os.makedirs(spill_dir, exist_ok=True)
+        self.prefix = os.path.join(spill_dir, name)
+        self.put = put
+        self.segment_bytes = segment_mb * 1024**2
+
+        # Replay any segments left over from a previous run
+        segment_pattern = f"{glob.escape(self.prefix)}_{'[0-9]'*5}.spill"
+        self.closed_fnames = sorted(glob.glob(segment_pattern))
+        self.n_bytes = sum(os.path.getsize(f) for f in self.closed_fnames)
+        if len(self.closed_fnames) > 0:
+            self.segment_number = int(self.closed_fnames[-1][-11:-6]) + 1
+        else:
+            self.segment_number = 0
+        self.segment_f = None
+        self.spilling = len(self.closed_fnames) > 0
+
+        self.closing = False
+        self.error = None
+        self.lock = threading.Lock()
+        self.has_segments = threading.Condition(self.lock)
+        self.replayer = threading.Thread(target=self.replay, daemon=True)
+
+
+    def start(self):
+        """
+        Starts replaying segments in the background
+        """
+        self.replayer.start()
+
+
+    def append(self, message):
+        """
+        Appends a message to the current segment
+
+        Parameters
+        ----------
+        message: bytes
+            Message to spill. Must not contain a newline
+        """
+        if self.error is not None:
+            raise self.error
+        with self.lock:
+            if self.segment_f is None or self.segment_f.tell() >= self.segment_bytes:
+                self.close_segment()
+                self.segment_fname = f"{self.prefix}_{self.segment_number:05d}.spill"
+                self.segment_f = open(self.segment_fname, 'ab')
+                self.segment_number += 1
+            self.segment_f.write(message + b'\n')
+            self.segment_f.flush()
+            self.n_bytes += len(message) + 1
+            self.spilling = True
+            self.has_segments.notify()
+
+
+    def close_segment(self):
+        """
+        Closes the current segment, if any, so that it can be replayed. Must be
+        called while holding the lock
+        """
+        if self.segment_f is not None:
+            self.segment_f.close()
+            self.closed_fnames.append(self.segment_fname)
+            self.segment_f = None
+
+
+    def replay(self):
+        """
+        Puts the messages of each segment on the queue, oldest first, and
+        deletes the segment once all of its messages are on the queue. Stops
+        spilling once every segment has been replayed
+        """
+        try:
+            while True:
+                with self.lock:
+                    while (len(self.closed_fnames) == 0 and self.segment_f is None
+                           and not self.closing):
+                        self.spilling = False
+                        self.has_segments.wait()
+                    if len(self.closed_fnames) == 0:
+                        if self.segment_f is None:
+                            # Closing and nothing is left to replay
+                            self.spilling = False
+                            return
+                        self.close_segment()
+                    segment_fname = self.closed_fnames[0]
+
+                with open(segment_fname, 'rb') as segment_f:
+                    for line in segment_f:
+                        self.put(line.rstrip(b'\n'))
+
+                with self.lock:
+                    self.closed_fnames.pop(0)
+                    self.n_bytes -= os.path.getsize(segment_fname)
+                    os.remove(segment_fname)
+        except Exception as e:
+            self.error = e
+
+
+    def close(self):
+        """
+        Waits for all segments to be replayed and stops the replay thread.
+        Segments that could not be replayed are kept on disk
+        """
+        with self.lock:
+            self.closing = True
+            self.has_segments.notify()
+        if self.replayer.is_alive():
+            self.replayer.join()
+        with self.lock:
+            if self.segment_f is not None:
+                self.close_segment()
+        if self.error is not None:
+            raise self.error
+
+
+    def get_state(self):
+        """
+        Returns the current size of the buffer
+
+        Returns
+        -------
+        state: dict
+            Dictionary of the number of segments and bytes waiting to be
+            replayed
+        """
+        with self.lock:
+            n_segments = len(self.closed_fnames) + (self.segment_f is not None)
+            state = {'n_segments': n_segments,
+                     'n_bytes': self.n_bytes}
+        return state
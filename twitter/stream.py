@@ -1,17 +1,33 @@
+import os
 import sys
-import json
+import time
 import yaml
 import queue
+import random
 import signal
 import argparse
 import requests
+import warnings
+import traceback
 import numpy as np
 from pprint import pprint
 from datetime import datetime
+from datetime import timezone
+from dateutil import parser as dateparser
+from multiprocessing import Lock
 from multiprocessing import Queue
 from multiprocessing import Process
+from multiprocessing import get_context
 from .helper import *
+from .codec import json_loads
 from .listener import APIListener
+from .spill import SpillBuffer
+from .search import SearchListener, date_format
+
+# Errors that mean the stream connection was lost and should be reconnected
+STREAM_ERRORS = (requests.exceptions.ConnectionError,
+                 requests.exceptions.ChunkedEncodingError,
+                 requests.exceptions.Timeout)
 
 
 class StreamListener(APIListener):
@@ -39,8 +55,39 @@ class StreamListener(APIListener):
     update_interval: int
         How often to print updates of the number of tweets collected, in minutes
     n_mins_timeout: int
-        How many minutes before the writing queue times out from not receiving
-        any data
+        How many minutes without receiving any tweets before the stream is
+        ended. Keep-alive heartbeats do not count as tweets
+    stall_secs: float
+        How many seconds without receiving anything from the stream, including
+        the keep-alive heartbeats the API sends every 20 seconds, before the
+        connection is considered stalled and is reconnected. Defaults to 90
+    batch_size: int
+        The maximum number of tweets the writer collects before writing them to
+        the database and JSON file all at once. Defaults to 500
+    batch_secs: float
+        The maximum number of seconds the writer waits for a batch to fill
+        before writing it anyway. Defaults to 2
+    n_writers: int
+        The number of writer processes that parse, extract, and write tweets,
+        each with its own database connection. If writing to a compressed
+        archive, writers after the first write to their own archives named
+        `{event}_writer{n}`. Defaults to 1
+    queue_size: int
+        The maximum number of messages waiting to be written. If the writers
+        fall behind, further messages are spilled to disk as set by the `spill`
+        fields of the config file, or reading from the stream waits for them if
+        spilling is not set. Defaults to 10,000
+    max_reconnect_secs: float
+        The longest to wait between attempts to reconnect after the stream
+        disconnects, in seconds. Defaults to 320
+    backfill_gaps: bool
+        Whether to search for tweets matching the stream's rules that were
+        posted while the stream was disconnected, once it reconnects. Backfills
+        run one at a time in a separate process, so that they do not write to
+        the search output at the same time. Defaults to False
+    session: requests.Session
+        HTTP session to make API calls with. Defaults to a new pooled session
+        configured by the `http` fields of the config file
     dry_run: bool
         Whether to run a "dry run" of the rules without connnecting to the
         Twitter stream to make sure that the query rules are syntactically valid
@@ -52,15 +99,25 @@ class StreamListener(APIListener):
                  append,
                  verbose,
                  update_interval,
-                 n_mins_timeout):
+                 n_mins_timeout,
+                 batch_size=500,
+                 batch_secs=2,
+                 n_writers=1,
+                 queue_size=10000,
+                 max_reconnect_secs=320,
+                 backfill_gaps=False,
+                 stall_secs=90,
+                 session=None):
         super().__init__(
             event=event,
             query_type='stream',
             config_f=config_f,
             append=append,
             verbose=verbose,
-            update_interval=update_interval
+            update_interval=update_interval,
+            session=session
         )
+        self.config_f = config_f
         self.rate_limit = np.inf
         self.n_calls_last_15mins = -1 * np.inf
 
@@ -74,12 +131,37 @@ class StreamListener(APIListener):
             self.rules = yaml.load(fin, Loader=yaml.Loader)['rules']
         self.params = self.request_fields
 
-        # Separate computing process for writing tweets
-        self.n_secs_timeout = 60 * n_mins_timeout
-        self.write_queue = Queue()
-        self.writer = Process(target=self.manage_writing, daemon=True)
+        # Separate computing processes for writing tweets
+        self.batch_size = batch_size
+        self.batch_secs = batch_secs
+        self.write_queue = Queue(maxsize=queue_size)
+        self.writers = [Process(target=self.run_writer, args=(n,), daemon=True)
+                        for n in range(n_writers)]
 
-        self.out_json_f = open(self.out_json_fname, self.write_mode)
+        # Timeouts and reconnecting
+        self.n_secs_timeout = 60 * n_mins_timeout
+        self.stall_secs = stall_secs
+        self.max_reconnect_secs = max_reconnect_secs
+        self.backfill_gaps = backfill_gaps
+        self.last_message_time = None
+        self.backfill_queue = None
+        self.backfill_process = None
+
+        # Overflow of the writing queue to disk
+        try:
+            self.spill_config = self.config['spill']['twitter']
+        except KeyError:
+            self.spill_config = None
+        self.spill = None
+
+        # A single JSON file is shared by the writers, while archives are opened
+        # by each writer since their segments and index can't be shared
+        if self.archive_config.get('compression') is None:
+            self.out_json_f = self.open_out_json()
+            if n_writers > 1:
+                self.out_json_lock = Lock()
+        else:
+            self.out_json_f = None
 
 
     def get_rules(self):
@@ -95,7 +177,7 @@ class StreamListener(APIListener):
             "summary", which holds a dictionary of how many rules were "created"
             and "not_created", and how many were "valid" and "invalid"
         """
-        response = requests.get(self.rules_endpoint, headers=self.headers)
+        response = self.session.get(self.rules_endpoint, timeout=self.timeout)
         self.check_response_exception(response)
         if 'data' in response.json():
             self.api_rules_response = response.json()
@@ -113,8 +195,8 @@ class StreamListener(APIListener):
 
         rule_ids = list(map(lambda r: r["id"], self.api_rules_response["data"]))
         to_delete = {"delete": {"ids": rule_ids}}
-        response = requests.post(self.rules_endpoint, headers=self.headers,
-                                 json=to_delete)
+        response = self.session.post(self.rules_endpoint, json=to_delete,
+                                     timeout=self.timeout)
         self.check_response_exception(response)
         # Make sure api_rules_response is updated
         self.get_rules()
@@ -128,8 +210,8 @@ class StreamListener(APIListener):
             self.delete_rules()
 
         to_add = {"add": self.rules}
-        response = requests.post(self.rules_endpoint, headers=self.headers,
-                                 json=to_add)
+        response = self.session.post(self.rules_endpoint, json=to_add,
+                                     timeout=self.timeout)
         self.check_response_exception(response)
         # Make sure api_rules_response is updated
         self.get_rules()
@@ -138,86 +220,523 @@ class StreamListener(APIListener):
     def stream(self):
         """
         Connects to the Twitter filter stream and writes out the returned data
-        to both a JSON file and a Postgres database.
+        to both a JSON file and a Postgres database. Reconnects if the stream
+        disconnects, backing off exponentially while reconnecting fails, and
+        backfills the time it was disconnected if `backfill_gaps` is set
         """
-        self.writer.start()
-
-        # Wait to set this until here, otherwise it sets it for both processes
+        # Each writer opens its own database connection, and a connection can't
+        # be shared across processes, so the reader's is closed first
+        self.cur.close()
+        self.conn.close()
+        for writer in self.writers:
+            writer.start()
+        # Start spilling after forking, since the replay thread lives here
+        if self.spill_config is not None:
+            self.spill = SpillBuffer(self.spill_config['dir'], self.event,
+                                     self.put_message,
+                                     segment_mb=self.spill_config['segment_mb'])
+            self.spill.start()
+
+        # Wait to set this until here, otherwise it sets it for all processes
         # and we only want this exit handler for the main thread
         signal.signal(signal.SIGINT, self.exit_handler)
 
-        # Connect to stream
-        response = requests.get(self.stream_endpoint, headers=self.headers,
-                                params=self.params, stream=True)
+        try:
+            n_failures = 0
+            gap_start_time = None
+            # Until a tweet is received, gaps are counted from the start
+            self.last_message_time = time.time()
+            while not self.stop:
+                self.check_rate_limit()
+                response = None
+                http_error = False
+                try:
+                    response = self.connect_stream()
+                    if response is None:
+                        http_error = True
+                    else:
+                        n_failures = 0
+                        if gap_start_time is not None and self.backfill_gaps:
+                            self.start_backfill(gap_start_time, time.time())
+                        gap_start_time = None
+                        self.read_stream(response)
+                except STREAM_ERRORS as err:
+                    if self.verbose:
+                        print(f"\nStream connection error: {err}")
+                finally:
+                    if response is not None:
+                        response.close()
+                if self.stop:
+                    return
+                if time.time() - self.last_message_time > self.n_secs_timeout:
+                    print("No tweets received before the timeout. Ending the stream")
+                    self.stop = True
+                    return
+
+                # Reconnect, backing off exponentially if it keeps failing.
+                # HTTP errors are backed off by `check_rate_limit` instead
+                if gap_start_time is None:
+                    gap_start_time = self.last_message_time
+                if not http_error:
+                    n_failures += 1
+                    n_sleep_secs = self.get_reconnect_secs(n_failures)
+                    if self.verbose:
+                        print(f"Disconnected from the filter stream. "
+                              f"Reconnecting in {n_sleep_secs:.1f} seconds")
+                    time.sleep(n_sleep_secs)
+        finally:
+            self.stop_writers()
+            self.stop_backfills()
+
+
+    def connect_stream(self):
+        """
+        Connects to the filter stream
+
+        Returns
+        -------
+        response: obj
+            The streaming response, or None if the API returned an error that
+            can be retried, i.e. it is unavailable or over the rate limit
+        """
+        # The API sends a heartbeat every 20 seconds even without tweets, so a
+        # read that takes longer than that means the connection has stalled
+        response = self.session.get(self.stream_endpoint, params=self.params,
+                                    stream=True,
+                                    timeout=(self.timeout[0], self.stall_secs))
         self.check_response_exception(response)
+        if not response.ok:
+            response.close()
+            return None
         if self.verbose:
             print('Connected to the filter stream')
             print('Streaming tweets...')
+        return response
 
-        # Read tweets and put them on queue to write
-        # Note: if a small number of tweets are coming in, then the stream will
-        # not stop after CTRL+c until the next tweet comes in. Until then, the
-        # process is caught up in response.iter_lines()
+
+    def read_stream(self, response):
+        """
+        Reads tweets from the stream and puts them on the queue to write, until
+        the stream is stopped or disconnected
+
+        Parameters
+        ----------
+        response: obj
+            The streaming response
+        """
+        # Blank lines are heartbeats. Each line, including heartbeats, returns
+        # control here, so stopping is noticed within one heartbeat. The quiet
+        # period is counted from the last tweet on any connection, so a stream
+        # that keeps stalling and reconnecting still ends
         for response_line in response.iter_lines():
+            now = time.time()
             if response_line:
                 self.check_rate_limit()
 
-                response_json = json.loads(response_line)
                 self.check_response_exception(response)
                 if self.pause or self.temp_unavail:
                     continue
-                self.write_queue.put((response_json, self.stop))
+                # Tweet messages start with their data. Anything else is only
+                # parsed here to check for errors, since they are rare
+                if not response_line.startswith(b'{"data"'):
+                    message = json_loads(response_line)
+                    if 'data' not in message:
+                        if self.check_stream_errors(message):
+                            return
+                        continue
+                self.last_message_time = now
+                # Parsing is left to the writers to keep the reader fast
+                self.enqueue(response_line)
 
                 self.n_tweets_total += 1
                 self.n_tweets_since_update += 1
+            elif now - self.last_message_time > self.n_secs_timeout:
+                print("No tweets received before the timeout. Ending the stream")
+                self.stop = True
 
-                if self.stop:
-                    return
+            if self.stop:
+                return
 
 
-    def manage_writing(self):
+    def check_stream_errors(self, message):
         """
-        Retrieves data from the writing queue and writes it. Handles keyboard
-        except for a CTRL+C exit
+        Prints a stream message that has errors instead of tweets, e.g. a rule
+        that could not be applied or a disconnect for operational reasons
+
+        Parameters
+        ----------
+        message: dict
+            The parsed stream message
+
+        Returns
+        -------
+        disconnected: bool
+            Whether the API disconnected the stream, so it should be reconnected
         """
-        try:
-            while True:
+        print('\nStream returned a message without tweets:')
+        pprint(message)
+        for error in message.get('errors', []):
+            error_type = f"{error.get('title', '')} {error.get('type', '')}"
+            if 'disconnect' in error_type.lower():
+                return True
+        return False
+
+
+    def get_reconnect_secs(self, n_failures):
+        """
+        Returns the number of seconds to wait before reconnecting. The wait
+        doubles with each consecutive failed connection, up to
+        `max_reconnect_secs`, and a random half of it is jitter
+
+        Parameters
+        ----------
+        n_failures: int
+            The number of consecutive times the stream has disconnected or
+            failed to connect
+        """
+        cap = min(self.max_reconnect_secs, 2**(n_failures - 1))
+        return cap / 2 + random.uniform(0, cap / 2)
+
+
+    def start_backfill(self, gap_start_time, gap_end_time):
+        """
+        Queues a search of the stream's rules over the time the stream was
+        disconnected. Searches are run one after another by a single backfill
+        process, which is started with the first gap and restarted if it has
+        died, carrying over any gaps it had not taken yet
+
+        Parameters
+        ----------
+        gap_start_time: float
+            When the last message was received before disconnecting, in seconds
+            since the epoch
+        gap_end_time: float
+            When the stream reconnected, in seconds since the epoch
+        """
+        # Start a little early to cover tweets that were still on their way
+        start_time = datetime.fromtimestamp(gap_start_time - 30, timezone.utc)
+        end_time = datetime.fromtimestamp(gap_end_time, timezone.utc)
+        queries = [rule['value'] for rule in self.rules]
+        if self.verbose:
+            print(f"Backfilling the stream from {start_time} to {end_time}")
+        if self.backfill_process is not None and not self.backfill_process.is_alive():
+            warnings.warn("The backfill process stopped unexpectedly, restarting it")
+            self.backfill_process = None
+        if self.backfill_process is None:
+            # Spawned rather than forked so that it doesn't inherit the
+            # reader's threads and connections
+            context = get_context('spawn')
+            prev_queue = self.backfill_queue
+            self.backfill_queue = context.Queue()
+            while prev_queue is not None:
                 try:
-                    response_json,stop = self.write_queue.get(timeout=self.n_secs_timeout)
+                    self.backfill_queue.put(prev_queue.get(block=False))
                 except queue.Empty:
-                    # TODO: even if this times out, the main thread doesn't
-                    # end because it's caught waiting for something from iter_lines()
-                    # and it never reaches `stop`. Also `stop` isn't even
-                    # shared between the main process and the writing process
-                    print("Stream timed out. Ending the stream")
+                    prev_queue = None
+            self.backfill_process = context.Process(target=run_backfills,
+                                                    args=(self.event, self.config_f,
+                                                          self.backfill_queue,
+                                                          self.verbose))
+            self.backfill_process.start()
+        self.backfill_queue.put((queries,
+                                 start_time.strftime(date_format),
+                                 end_time.strftime(date_format)))
+
+
+    def stop_backfills(self):
+        """
+        Tells the backfill process to stop once it has searched all the gaps
+        queued before now. Does not wait for it to finish
+        """
+        if self.backfill_process is not None:
+            self.backfill_queue.put(None)
+
+
+    def enqueue(self, message):
+        """
+        Puts a message on the writing queue, or spills it to disk if the queue
+        is full. Once spilling, messages keep going to disk until everything
+        spilled has been replayed onto the queue, so their order is kept
+
+        Parameters
+        ----------
+        message: bytes
+            Raw line of the stream message
+        """
+        if self.spill is None:
+            self.put_message(message)
+            return
+        if not self.spill.spilling:
+            try:
+                self.write_queue.put_nowait(message)
+                return
+            except queue.Full:
+                pass
+        self.spill.append(message)
+
+
+    def put_message(self, message):
+        """
+        Puts a message on the writing queue, waiting while the queue is full
+
+        Parameters
+        ----------
+        message: bytes
+            Raw line of the stream message, or None to tell a writer to stop
+        """
+        while True:
+            try:
+                self.write_queue.put(message, timeout=1)
+                return
+            except queue.Full:
+                if not any(writer.is_alive() for writer in self.writers):
+                    raise RuntimeError("All stream writers have stopped")
+
+
+    def stop_writers(self):
+        """
+        Tells each writer to stop once it has written everything before it on
+        the queue, and waits for them to finish
+        """
+        if self.verbose:
+            print("\n\tFinishing writing...")
+        try:
+            if self.spill is not None:
+                self.spill.close()
+        finally:
+            for writer in self.writers:
+                if writer.is_alive():
+                    self.put_message(None)
+            for writer in self.writers:
+                writer.join()
+        if self.verbose:
+            print("\tFinished writing remainder of queue")
+
+
+    def get_queue_state(self):
+        """
+        Returns how far behind the writers are
+
+        Returns
+        -------
+        state: dict
+            Dictionary of the number of messages on the writing queue, and the
+            number of segments and bytes spilled to disk and waiting to be
+            replayed
+        """
+        try:
+            queue_depth = self.write_queue.qsize()
+        except NotImplementedError:
+            # Not available on macOS
+            queue_depth = None
+        if self.spill is None:
+            spill_state = {'n_segments': 0, 'n_bytes': 0}
+        else:
+            spill_state = self.spill.get_state()
+        state = {'queue_depth': queue_depth,
+                 'n_spill_segments': spill_state['n_segments'],
+                 'n_spill_bytes': spill_state['n_bytes']}
+        return state
+
+
+    def print_update(self, n_tweets, n_mins):
+        """
+        Prints out the number of tweets that have been retrieved from the API
+        since the last update, and how far behind the writers are
+
+        Parameters
+        ----------
+        n_tweets: int
+            The number of tweets since the last update
+        n_mins:
+            The number of minutes since the last update
+        """
+        super().print_update(n_tweets, n_mins)
+        state = self.get_queue_state()
+        out_str = f"\t{state['queue_depth']} messages queued"
+        if state['n_spill_bytes'] > 0:
+            spill_mb = state['n_spill_bytes'] / 1024**2
+            out_str = f"{out_str} | {spill_mb:,.1f} MB spilled to disk"
+        print(out_str)
+
+
+    def run_writer(self, writer_n):
+        """
+        Runs a writer process: connects to the database, opens the writer's
+        JSON output if needed, and writes from the queue until told to stop
+
+        Parameters
+        ----------
+        writer_n: int
+            The number of the writer, from 0 to `n_writers` - 1
+        """
+        # The reader handles CTRL+C and tells the writers when to stop, so that
+        # they can write and commit everything already on the queue
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.connect_db()
+        if self.write_method == 'copy':
+            self.set_stage_tables()
+        if self.out_json_f is None:
+            if writer_n == 0:
+                out_json_fname = self.out_json_fname
+            else:
+                out_json_fname = f"{self.out_json_dir}/{self.event}_writer{writer_n}.json"
+            self.out_json_f = self.open_out_json(out_json_fname)
+
+        try:
+            self.manage_writing()
+        finally:
+            if self.out_json_lock is None:
+                self.out_json_f.close()
+            else:
+                with self.out_json_lock:
+                    self.out_json_f.flush()
+            self.cur.close()
+            self.conn.close()
+
+
+    def manage_writing(self):
+        """
+        Retrieves data from the writing queue and writes it in batches. A batch
+        is written once it has `batch_size` tweets or its first tweet has waited
+        `batch_secs` seconds. Writes the last batch once a stop message (None)
+        is taken from the queue
+        """
+        batch = []
+        batch_start_time = None
+        while True:
+            if len(batch) > 0:
+                n_secs_waited = time.time() - batch_start_time
+                timeout = max(0, self.batch_secs - n_secs_waited)
+            else:
+                # The reader decides when the stream ends and says so with a
+                # stop message, so wait for as long as it takes
+                timeout = None
+            try:
+                response_line = self.write_queue.get(timeout=timeout)
+                if response_line is None:
                     self.stop = True
+                else:
+                    if len(batch) == 0:
+                        batch_start_time = time.time()
+                    batch.append(response_line)
+            except queue.Empty:
+                # The batch has waited long enough
+                pass
 
-                if self.stop:
-                    return
+            if self.stop:
+                self.write_batch(batch)
+                return
 
-                super().manage_writing(response_json)
+            n_secs_waited = time.time() - batch_start_time
+            if len(batch) >= self.batch_size or n_secs_waited >= self.batch_secs:
+                self.write_batch(batch)
+                batch = []
 
-        except KeyboardInterrupt:
-            if self.verbose:
-                print("\n\tFinishing writing...")
-            while not self.write_queue.empty():
-                tweets = [response_json['data']]
-                includes = response_json['includes']
-                self.write_tweets(tweets, includes)
-            if self.verbose:
-                print("\tFinished writing remainder of queue")
+
+    def write_batch(self, batch):
+        """
+        Parses and writes a batch of stream messages all at once
+
+        Parameters
+        ----------
+        batch: list of bytes
+            Raw lines of the stream messages taken off of the writing queue
+        """
+        if len(batch) == 0:
+            return
+        response_json = merge_responses([json_loads(line) for line in batch])
+        if len(response_json['data']) > 0:
+            super().manage_writing(response_json)
 
 
 # ------------------------------------------------------------------------------
 # --------------------------- End of class definition --------------------------
 # ------------------------------------------------------------------------------
+def run_backfills(event, config_f, backfill_queue, verbose):
+    """
+    Searches the gaps of a stream one after another, as they are queued by
+    `StreamListener.start_backfill`, until a stop message (None) is taken from
+    the queue. Run in its own process, so that only one search writes to the
+    event's search output at a time. A gap that fails is reported and skipped,
+    so that the gaps after it are still searched
+
+    Parameters
+    ----------
+    event: str
+        The name of the streaming event
+    config_f: str
+        The configuration file to use
+    backfill_queue: multiprocessing.Queue
+        Queue of the queries, start time, and end time of each gap
+    verbose: bool
+        Whether to print out information/updates of the searches
+    """
+    # The reader handles CTRL+C and tells this process when to stop, so that
+    # every queued gap is searched. Searches set their own CTRL+C handler, so
+    # the process also leaves the terminal's process group where it can
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp()
+    while True:
+        gap = backfill_queue.get()
+        if gap is None:
+            return
+        queries,start_time,end_time = gap
+        try:
+            backfill_gap(event, config_f, queries, start_time, end_time, verbose)
+        except Exception:
+            print(f"\nFailed to backfill the stream from {start_time} to {end_time}:")
+            traceback.print_exc()
+
+
+def backfill_gap(event, config_f, queries, start_time, end_time, verbose):
+    """
+    Searches for tweets that were missed while the stream was disconnected.
+    Run by `run_backfills`
+
+    Parameters
+    ----------
+    event: str
+        The name of the streaming event
+    config_f: str
+        The configuration file to use
+    queries: list of strs
+        The stream's rules, searched as queries
+    start_time: str
+        Start of the gap, in RFC 3339 format
+    end_time: str
+        End of the gap, in RFC 3339 format
+    verbose: bool
+        Whether to print out information/updates of the search
+    """
+    # The search only allows end times at least 10 seconds in the past, and
+    # tweets take a little while longer to become searchable
+    n_secs_since_end = time.time() - dateparser.parse(end_time).timestamp()
+    time.sleep(max(0, 60 - n_secs_since_end))
+
+    search = SearchListener(event=event,
+                            config_f=config_f,
+                            start_time=start_time,
+                            end_time=end_time,
+                            append=True,
+                            verbose=verbose,
+                            queries=queries)
+    search.search()
+    search.conn.commit()
+    search.cur.close()
+    search.conn.close()
+    search.out_json_f.close()
+
+
 def main(event, delete_rules, config_f, append, verbose, update_interval,
-         n_mins_timeout, dry_run):
+         n_mins_timeout, batch_size, batch_secs, n_writers, queue_size,
+         max_reconnect_secs, backfill_gaps, stall_secs, dry_run):
     """
     Listens to the Twitter API v2 filter stream. First, it sets the rules to
     filter by. It then connects to the stream. Finally, it handles joining the
-    multiprocessing writing thread and, if applicable, closing any open writing
-    files
+    multiprocessing writing processes and, if applicable, closing any open
+    writing files
 
     See above class definition for parameter explanations
     """
@@ -228,13 +747,21 @@ def main(event, delete_rules, config_f, append, verbose, update_interval,
                             append=append,
                             verbose=verbose,
                             update_interval=update_interval,
-                            n_mins_timeout=n_mins_timeout)
+                            n_mins_timeout=n_mins_timeout,
+                            batch_size=batch_size,
+                            batch_secs=batch_secs,
+                            n_writers=n_writers,
+                            queue_size=queue_size,
+                            max_reconnect_secs=max_reconnect_secs,
+                            backfill_gaps=backfill_gaps,
+                            stall_secs=stall_secs)
     if dry_run:
         if stream.delete_existing_rules:
             stream.delete_rules()
         to_add = {"add": stream.rules}
-        response = requests.post(stream.rules_endpoint, headers=stream.headers,
-                                 json=to_add, params={'dry_run': True})
+        response = stream.session.post(stream.rules_endpoint, json=to_add,
+                                       params={'dry_run': True},
+                                       timeout=stream.timeout)
         print('Dry run results\n---------------')
         pprint(response.json())
         sys.exit()
@@ -242,12 +769,13 @@ def main(event, delete_rules, config_f, append, verbose, update_interval,
         stream.set_rules()
         stream.stream()
 
-        # Wait for the writing thread to finish and wrap up
-        stream.writer.join()
-        stream.out_json_f.close()
-        stream.conn.commit()
-        stream.cur.close()
-        stream.conn.close()
+        # The writers have finished, committed, and closed their connections
+        if stream.backfill_process is not None:
+            if verbose:
+                print('Waiting for backfills of the stream to finish')
+            stream.backfill_process.join()
+        if stream.out_json_f is not None:
+            stream.out_json_f.close()
         if verbose:
             print('\nClosed writing and committed changes to database')
             now = datetime.now().strftime("%Y-%m-%d %I:%M%p")
@@ -261,6 +789,12 @@ if __name__ == '__main__':
     parser.add_argument("-config", type=str, default="config.yaml")
     parser.add_argument("-update_interval", type=int, default=15)
     parser.add_argument("-n_mins_timeout", type=int, default=15)
+    parser.add_argument("-batch_size", type=int, default=500)
+    parser.add_argument("-batch_secs", type=float, default=2)
+    parser.add_argument("-n_writers", type=int, default=1)
+    parser.add_argument("-queue_size", type=int, default=10000)
+    parser.add_argument("-max_reconnect_secs", type=float, default=320)
+    parser.add_argument("-stall_secs", type=float, default=90)
     # Booleans can't be parsed directly, so you set a flag for each option
     parser.add_argument("--delete_rules", dest="delete_rules", action="store_true")
     parser.add_argument("--update_rules", dest="delete_rules", action="store_false")
@@ -269,7 +803,9 @@ if __name__ == '__main__':
     parser.add_argument("--quiet", dest="verbose", action="store_false")
     parser.add_argument("--overwrite", dest="append", action="store_false")
     parser.add_argument("--dry_run", dest="dry_run", action="store_true")
-    parser.set_defaults(delete_rules=True, append=True, dry_run=False)
+    parser.add_argument("--backfill_gaps", dest="backfill_gaps", action="store_true")
+    parser.set_defaults(delete_rules=True, append=True, dry_run=False,
+                        backfill_gaps=False)
 
     args = parser.parse_args()
 
@@ -280,4 +816,11 @@ if __name__ == '__main__':
          args.verbose,
          args.update_interval,
          args.n_mins_timeout,
+         args.batch_size,
+         args.batch_secs,
+         args.n_writers,
+         args.queue_size,
+         args.max_reconnect_secs,
+         args.backfill_gaps,
+         args.stall_secs,
          args.dry_run)